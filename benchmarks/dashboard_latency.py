@@ -0,0 +1,73 @@
+'''Dashboard Load Test: per-interaction latency with several concurrent simulated users'''
+
+import argparse
+import os
+import statistics
+import threading
+import time
+from collections import defaultdict
+
+from streamlit.testing.v1 import AppTest
+
+#Each simulated user repeats this sequence of widget interactions (label, action on the AppTest)
+interactions = [
+    ("Data Overview", lambda at: at.sidebar.radio[0].set_value("Data Overview")),
+    ("Filter population", lambda at: at.multiselect[1].set_value(["b_cell"])),
+    ("Immune Response Statistics", lambda at: at.sidebar.radio[0].set_value("Immune Response Statistics")),
+    ("Select timepoint 7", lambda at: at.selectbox[0].set_value(7)),
+    ("Subset Analysis", lambda at: at.sidebar.radio[0].set_value("Subset Analysis")),
+    ("Choose question", lambda at: at.selectbox[0].set_value("How many samples from each project?")),
+]
+
+
+def simulate_user(app, rounds, latencies, errors):
+    at = AppTest.from_file(app, default_timeout=120)
+    start = time.perf_counter()
+    at.run()
+    latencies["First load"].append(time.perf_counter() - start)
+
+    for _ in range(rounds):
+        for label, action in interactions:
+            start = time.perf_counter()
+            try:
+                action(at).run()
+            except Exception as e:
+                #A failed rerun leaves the widget tree empty, start this user over from a fresh session
+                errors.append((label, repr(e)))
+                at = AppTest.from_file(app, default_timeout=120)
+                at.run()
+                break
+            latencies[label].append(time.perf_counter() - start)
+            if at.exception:
+                errors.append((label, at.exception[0].message))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure dashboard rerun latency under concurrent simulated users (run from the repository root).")
+    parser.add_argument("--app", default="dashboard.py", help="Streamlit script to test")
+    parser.add_argument("--users", type=int, default=4, help="concurrent simulated users")
+    parser.add_argument("--rounds", type=int, default=3, help="times each user repeats the interaction sequence")
+    args = parser.parse_args()
+
+    latencies = defaultdict(list)
+    errors = []
+    threads = [threading.Thread(target=simulate_user, args=(os.path.abspath(args.app), args.rounds, latencies, errors)) for _ in range(args.users)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    print(f"{args.app}: {args.users} users x {args.rounds} rounds in {elapsed:.2f} s")
+    print(f"  {'interaction':<28} {'n':>4} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9}")
+    for label, values in latencies.items():
+        values = sorted(values)
+        p95 = values[min(len(values) - 1, int(0.95 * len(values)))]
+        print(f"  {label:<28} {len(values):>4} {statistics.mean(values) * 1000:>9.1f} {statistics.median(values) * 1000:>9.1f} {p95 * 1000:>9.1f}")
+    for label, message in errors[:5]:
+        print(f"  error during {label}: {message}")
+
+
+if __name__ == "__main__":
+    main()
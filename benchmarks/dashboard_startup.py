@@ -0,0 +1,120 @@
+'''Dashboard Startup Benchmark: import time of dashboard.py and cold time to first render of every page'''
+
+import argparse
+import ast
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+pages = ["Data Overview", "Immune Response Statistics", "Subset Analysis", "Cohort Explorer"]
+
+#Run in a fresh interpreter: render the app once (the default page), then switch to the page being measured
+render_script = """
+import json, sys, time
+start = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+imported = time.perf_counter()
+at = AppTest.from_file(sys.argv[1], default_timeout=120)
+at.run()
+first = time.perf_counter()
+if sys.argv[2] != at.sidebar.radio[0].value:
+    at.sidebar.radio[0].set_value(sys.argv[2]).run()
+print(json.dumps({'streamlit_import': imported - start, 'first_render': first - imported,
+                  'page_render': time.perf_counter() - first, 'errors': [e.message for e in at.exception]}))
+"""
+
+
+def top_level_imports(app):
+    '''Source of the module-level import statements of a script, i.e. what every fresh session pays for before rendering.'''
+    with open(app) as f:
+        tree = ast.parse(f.read())
+    return "\n".join(ast.unparse(node) for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom)))
+
+
+def import_times(app, top=10):
+    '''Total seconds to run the script's imports in a fresh interpreter (python -X importtime) and its slowest modules.
+
+    Streamlit itself is imported first and left out of the total, since the server has always loaded it.
+    '''
+    code = "import streamlit\n" + top_level_imports(app)
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=repo, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr)
+
+    #Lines look like "import time:  self [us] | cumulative | module", nesting shown by indentation
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not name.startswith("  "):
+            modules.append((name.strip(), int(cumulative) / 1e6))
+    #Only what is imported after streamlit counts; interpreter start-up (site, encodings) comes before it
+    names = [name for name, _ in modules]
+    modules = modules[names.index('streamlit') + 1:]
+    return sum(seconds for _, seconds in modules), sorted(modules, key=lambda m: -m[1])[:top]
+
+
+def render_times(app, page):
+    '''Cold timings of page in a fresh interpreter: wall time of the whole process and the phases reported from inside it.'''
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", render_script, app, page], cwd=repo, capture_output=True, text=True)
+    wall = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr)
+    return {'wall': wall, **json.loads(result.stdout.strip().splitlines()[-1])}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=repo, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the import time and cold first-render time of the dashboard (needs the Outputs of the batch scripts).")
+    parser.add_argument("--app", default=os.path.join(repo, "dashboard.py"), help="Streamlit script to measure")
+    parser.add_argument("--repeat", type=int, default=3, help="fresh interpreters per measurement; the fastest run is kept")
+    parser.add_argument("--results", default=os.path.join(repo, "benchmarks", "dashboard_startup.jsonl"), help="JSON lines file the records are appended to")
+    args = parser.parse_args()
+    app = os.path.abspath(args.app)
+
+    run = {
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+    }
+    records = []
+
+    #Import times vary with the disk cache, so the best of several cold interpreters is reported
+    total, slowest = min((import_times(app) for _ in range(args.repeat)), key=lambda result: result[0])
+    records.append({'measure': 'imports', 'seconds': round(total, 3), 'slowest': [[name, round(s, 3)] for name, s in slowest]})
+    print(f"Imports (excluding streamlit): {total:.3f} s")
+    for name, seconds in slowest[:5]:
+        print(f"  {name:<28}{seconds:8.3f} s")
+
+    for page in pages:
+        best = min((render_times(app, page) for _ in range(args.repeat)), key=lambda result: result['wall'])
+        if best['errors']:
+            print(f"{page}: {best['errors'][0]}", file=sys.stderr)
+        records.append({'measure': 'render', 'page': page, 'seconds': round(best['first_render'] + best['page_render'], 3),
+                        'first_render': round(best['first_render'], 3), 'page_render': round(best['page_render'], 3),
+                        'wall': round(best['wall'], 3), 'errors': len(best['errors'])})
+        print(f"{page:<28} first render {best['first_render']:6.3f} s  page {best['page_render']:6.3f} s  process {best['wall']:6.3f} s")
+
+    with open(args.results, "a") as f:
+        for record in records:
+            f.write(json.dumps({**run, **record}) + "\n")
+    print(f"Appended {len(records)} records to {args.results}")
+
+
+if __name__ == "__main__":
+    main()
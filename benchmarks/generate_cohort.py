@@ -0,0 +1,102 @@
+'''Synthetic Cohort: cell-count.csv files with the real schema at any size'''
+
+import argparse
+import math
+
+import numpy as np
+import pandas as pd
+
+#Mean and standard deviation of every population's count, close to the real cell-count.csv
+populations = {
+    'b_cell': (9900, 3150),
+    'cd8_t_cell': (25000, 4750),
+    'cd4_t_cell': (30400, 5250),
+    'nk_cell': (14950, 3850),
+    'monocyte': (20100, 4400),
+}
+
+#Condition -> (share of subjects, treatments), and the other per-subject columns with their shares
+conditions = {
+    'melanoma': (0.49, ['miraclib', 'phauximab']),
+    'carcinoma': (0.37, ['miraclib', 'phauximab']),
+    'healthy': (0.14, ['none']),
+}
+projects = (['prj1', 'prj2', 'prj3'], [0.43, 0.285, 0.285])
+sample_types = (['PBMC', 'WB'], [0.71, 0.29])
+
+#Every subject is sampled at each of these times from treatment start
+timepoints = [0, 7, 14]
+
+#Shift of the mean CD4 T-cell count in responders after treatment starts, so the analysis has an effect to find
+responder_cd4_shift = 2000
+
+
+def generate_subjects(first, n_subjects, rng, width):
+    '''One row per subject: project, condition, age, sex, treatment and response.'''
+    names = list(conditions)
+    condition = rng.choice(names, n_subjects, p=[conditions[name][0] for name in names])
+    treatment = np.empty(n_subjects, dtype=object)
+    for name, (_, treatments) in conditions.items():
+        mask = condition == name
+        treatment[mask] = rng.choice(treatments, mask.sum())
+    response = np.where(condition == 'healthy', None, rng.choice(['yes', 'no'], n_subjects))
+    return pd.DataFrame({
+        'project': rng.choice(projects[0], n_subjects, p=projects[1]),
+        'subject': [f"sbj{i:0{width}d}" for i in range(first, first + n_subjects)],
+        'condition': condition,
+        'age': rng.integers(50, 80, n_subjects),
+        'sex': rng.choice(['M', 'F'], n_subjects),
+        'treatment': treatment,
+        'response': response,
+        'sample_type': rng.choice(sample_types[0], n_subjects, p=sample_types[1]),
+    })
+
+
+def generate_chunk(first_subject, n_subjects, rng, subject_width, sample_width):
+    '''Samples of n_subjects consecutive subjects, one per timepoint each, in the CSV column order.'''
+    subjects = generate_subjects(first_subject, n_subjects, rng, subject_width)
+    chunk = subjects.loc[subjects.index.repeat(len(timepoints))].reset_index(drop=True)
+    chunk['time_from_treatment_start'] = np.tile(timepoints, n_subjects)
+    first_sample = first_subject * len(timepoints)
+    chunk['sample'] = [f"sample{i:0{sample_width}d}" for i in range(first_sample, first_sample + len(chunk))]
+
+    for population, (mean, sd) in populations.items():
+        chunk[population] = rng.normal(mean, sd, len(chunk))
+    treated_responders = (chunk['response'] == 'yes') & (chunk['time_from_treatment_start'] > 0)
+    chunk.loc[treated_responders, 'cd4_t_cell'] += responder_cd4_shift
+    for population, (mean, _) in populations.items():
+        chunk[population] = chunk[population].clip(lower=mean / 5).round().astype(np.int64)
+
+    return chunk[['project', 'subject', 'condition', 'age', 'sex', 'treatment', 'response', 'sample',
+                  'sample_type', 'time_from_treatment_start'] + list(populations)]
+
+
+def generate(path, n_samples, seed=0, chunk_subjects=100000):
+    '''Write a synthetic cell-count CSV with about n_samples samples (whole subjects of len(timepoints) samples).
+
+    Subjects are generated chunk_subjects at a time, so memory stays flat however large the file is.
+    Returns the number of samples written.
+    '''
+    rng = np.random.default_rng(seed)
+    n_subjects = math.ceil(n_samples / len(timepoints))
+    subject_width = max(3, len(str(n_subjects - 1)))
+    sample_width = max(5, len(str(n_subjects * len(timepoints) - 1)))
+    for first in range(0, n_subjects, chunk_subjects):
+        chunk = generate_chunk(first, min(chunk_subjects, n_subjects - first), rng, subject_width, sample_width)
+        chunk.to_csv(path, mode="w" if first == 0 else "a", header=first == 0, index=False)
+    return n_subjects * len(timepoints)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic cell-count.csv with the same schema as the real one.")
+    parser.add_argument("samples", type=int, help="number of samples (rounded up to whole subjects)")
+    parser.add_argument("--output", default="cell-count-synthetic.csv", help="CSV file to write")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    written = generate(args.output, args.samples, args.seed)
+    print(f"Wrote {written:,} samples to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
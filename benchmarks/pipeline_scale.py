@@ -0,0 +1,143 @@
+'''Pipeline Benchmark: wall time, peak RSS and database size of the four parts on synthetic cohorts'''
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from generate_cohort import generate
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#Stages in run order: (name, script arguments)
+stages = [
+    ('load_data', ["load_data.py"]),
+    ('summary', ["summary.py"]),
+    ('stat_analysis', ["stat_analysis.py", "--headless"]),
+    ('subset_analysis', ["subset_analysis.py"]),
+]
+
+
+def run_stage(args, cwd):
+    '''Run one script with cwd as its working directory and return (exit code, seconds, peak RSS in MB).
+
+    Peak RSS is the script's own process (not the worker processes it starts), taken from the rusage
+    returned by wait4; it is None where wait4 is not available. stderr goes to a temporary file rather
+    than a pipe, so a stage that writes more than a pipe buffer of warnings can't block while we wait.
+    '''
+    with tempfile.TemporaryFile() as stderr:
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable] + args, cwd=cwd, stdout=subprocess.DEVNULL, stderr=stderr)
+        if hasattr(os, "wait4"):
+            _, status, usage = os.wait4(process.pid, 0)
+            elapsed = time.perf_counter() - start
+            process.returncode = os.waitstatus_to_exitcode(status)
+            #ru_maxrss is in kilobytes on Linux and bytes on macOS
+            peak = usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+        else:
+            process.wait()
+            elapsed, peak = time.perf_counter() - start, None
+        if process.returncode != 0:
+            stderr.seek(0)
+            print(stderr.read().decode(errors="replace"), file=sys.stderr)
+    return process.returncode, elapsed, peak
+
+
+def benchmark(n_samples, workdir, seed=0, load_args=()):
+    '''Generate a cohort of n_samples in workdir, run every stage against it and return one record per stage.'''
+    os.makedirs(os.path.join(workdir, "Outputs"), exist_ok=True)
+    start = time.perf_counter()
+    written = generate(os.path.join(workdir, "cell-count.csv"), n_samples, seed)
+    print(f"{written:,} samples: generated in {time.perf_counter() - start:.1f} s")
+
+    records = []
+    for name, args in stages:
+        args = [os.path.join(repo, args[0])] + args[1:] + (list(load_args) if name == 'load_data' else [])
+        code, elapsed, peak = run_stage(args, workdir)
+        db = os.path.join(workdir, "Outputs", "loblawbio.db")
+        records.append({
+            'samples': written,
+            'stage': name,
+            'seconds': round(elapsed, 3),
+            'peak_rss_mb': round(peak, 1) if peak is not None else None,
+            'db_mb': round(os.path.getsize(db) / 1e6, 2) if os.path.exists(db) else None,
+            'returncode': code,
+        })
+        print(f"  {name:<16}{elapsed:>9.2f} s  {records[-1]['peak_rss_mb'] or float('nan'):>9.1f} MB RSS  {records[-1]['db_mb'] or float('nan'):>8.2f} MB db")
+        if code != 0:
+            break
+    return records
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=repo, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def latest_records(baseline_path):
+    '''The latest record of every (samples, stage) in a results file.'''
+    latest = {}
+    with open(baseline_path) as f:
+        for line in f:
+            record = json.loads(line)
+            latest[(record['samples'], record['stage'])] = record
+    return latest
+
+
+def regressions(records, baseline, tolerance):
+    '''Stages that took more than (1 + tolerance) x their time in baseline (from latest_records) at the same size.'''
+    slower = []
+    for record in records:
+        base = baseline.get((record['samples'], record['stage']))
+        #Sub-second stages are mostly interpreter start-up and too noisy to compare
+        if base and record['seconds'] > 1 and record['seconds'] > base['seconds'] * (1 + tolerance):
+            slower.append((record, base))
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark load_data, summary, stat_analysis and subset_analysis on synthetic cohorts.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000], help="cohort sizes in samples (e.g. 10000 100000 1000000 10000000)")
+    parser.add_argument("--results", default=os.path.join(repo, "benchmarks", "pipeline_scale.jsonl"), help="JSON lines file the records are appended to")
+    parser.add_argument("--baseline", help="results file to compare against; exits with an error if a stage got slower")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown against the baseline (0.25 = 25%%)")
+    parser.add_argument("--stream", action="store_true", help="load with load_data.py --stream (for the largest sizes)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", help="generate the cohorts under this directory and keep them, instead of a temporary one")
+    args = parser.parse_args()
+
+    run = {
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+    }
+    #Read before this run appends to --results, which is usually the same file as the baseline
+    baseline = latest_records(args.baseline) if args.baseline else None
+    records = []
+    with tempfile.TemporaryDirectory() as tmp:
+        root = args.keep or tmp
+        for size in args.sizes:
+            records += benchmark(size, os.path.join(root, f"n{size}"), args.seed, ["--stream"] if args.stream else [])
+
+    with open(args.results, "a") as f:
+        for record in records:
+            f.write(json.dumps({**run, **record}) + "\n")
+    print(f"Appended {len(records)} records to {args.results}")
+
+    failed = [record for record in records if record['returncode'] != 0]
+    slower = regressions(records, baseline, args.tolerance) if baseline is not None else []
+    for record, base in slower:
+        print(f"Regression: {record['stage']} at {record['samples']:,} samples took {record['seconds']:.2f} s against {base['seconds']:.2f} s at {base['commit']}")
+    sys.exit(1 if failed or slower else 0)
+
+
+if __name__ == "__main__":
+    main()
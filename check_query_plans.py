@@ -0,0 +1,84 @@
+'''Query Plan Check: fail if any project query regresses to a full table scan, or a paged query to a sort'''
+
+import argparse
+import re
+import sqlite3
+import sys
+
+import queries
+
+database = "Outputs/loblawbio.db"
+
+#Matches "FROM subjects su", "JOIN samples AS sa", "FROM cell_counts" ...
+table_ref = re.compile(r"\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?", re.IGNORECASE)
+keywords = {'where', 'join', 'on', 'group', 'order', 'limit', 'left', 'inner', 'cross', 'using', 'union'}
+
+
+def aliases(sql):
+    '''Map every table name and alias in sql to the table it refers to.'''
+    names = {}
+    for table, alias in table_ref.findall(sql):
+        names[table] = table
+        if alias and alias.lower() not in keywords:
+            names[alias] = table
+    return names
+
+
+def full_scans(con, sql, params=()):
+    '''Return (table, plan detail) for every base table the query plan scans in full.'''
+    tables = {row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    names = aliases(sql)
+    scans = []
+    for _, _, _, detail in con.execute("EXPLAIN QUERY PLAN " + sql, params):
+        match = re.match(r"SCAN (?:TABLE )?(\w+)", detail)
+        if match:
+            #Scans of materialized subqueries (e.g. "SCAN totals") are not base tables
+            table = names.get(match.group(1), match.group(1))
+            if table in tables:
+                scans.append((table, detail))
+    return scans
+
+
+def sorts(con, sql, params=()):
+    '''Return the plan details of every temporary B-tree the query builds to satisfy its ORDER BY.'''
+    return [detail for _, _, _, detail in con.execute("EXPLAIN QUERY PLAN " + sql, params) if "FOR ORDER BY" in detail]
+
+
+def check(db_path=database, verbose=False):
+    '''Check every query in queries.catalog, returning the list of regressions.'''
+    con = sqlite3.connect(db_path)
+    failures = []
+    try:
+        for name, (sql, params) in queries.catalog.items():
+            allowed = queries.allowed_scans.get(name, set())
+            for table, detail in full_scans(con, sql, params):
+                if table not in allowed:
+                    failures.append((name, detail))
+            if name in queries.index_ordered:
+                failures.extend((name, detail) for detail in sorts(con, sql, params))
+            if verbose:
+                print(f"{name}:")
+                for row in con.execute("EXPLAIN QUERY PLAN " + sql, params):
+                    print(f"    {row[3]}")
+    finally:
+        con.close()
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run EXPLAIN QUERY PLAN over every project query and fail on full table scans and sorted pages.")
+    parser.add_argument("--db", default=database, help="SQLite database built by load_data.py")
+    parser.add_argument("-v", "--verbose", action="store_true", help="print every query plan")
+    args = parser.parse_args()
+
+    failures = check(args.db, args.verbose)
+    if failures:
+        print("Full table scans or sorted pages found:")
+        for name, detail in failures:
+            print(f"  {name}: {detail}")
+        sys.exit(1)
+    print(f"All {len(queries.catalog)} queries use indexes.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,39 +1,102 @@
 import streamlit as st
-import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
 import io
+import os
+import time
+
+import instrumentation
+from dashboard_data import DashboardData
+from exports import parquet_path, read_table
+
+#matplotlib and stat_tests (scipy) take about 1.4 s to import together, so they are imported by the pages
+#that use them rather than here; a fresh session's first page is not kept waiting on them
+#(see benchmarks/dashboard_startup.py)
+
+#Data is loaded lazily by the page that needs it and cached per (path, modification times), so widget
+#interactions don't re-parse the tables and a rerun of the batch scripts is picked up automatically
+@st.cache_data(show_spinner=False)
+def _read_table(path, mtimes):
+    df = read_table(path)
+    df.columns = df.columns.str.strip().str.lower()
+    return df
+
+
+@st.cache_data(show_spinner=False)
+def _read_bytes(path, mtime):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def load_table(path):
+    '''Load an output table through exports.read_table, which prefers the typed Parquet copy written with --parquet.'''
+    #Keyed on both files, so writing or removing the Parquet copy invalidates the cache too
+    mtimes = tuple(os.path.getmtime(p) if os.path.exists(p) else None for p in (path, parquet_path(path)))
+    return _read_table(path, mtimes)
+
+
+def load_bytes(path):
+    return _read_bytes(path, os.path.getmtime(path))
+
+
+def png_bytes(fig):
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png")
+    return buf.getvalue()
+
+
+def summary_boxplot(stratum, populations, title):
+    '''Responder vs. non-responder boxplots drawn from the precomputed box statistics, never the raw rows.'''
+    #A bare Figure instead of pyplot: lighter to import, and figures aren't kept alive by pyplot's global state
+    from matplotlib.figure import Figure
+
+    summary = load_table("Outputs/boxplot_summary.csv")
+    outliers = load_table("Outputs/boxplot_outliers.csv")
+    summary = summary[(summary['stratum'].astype(str) == stratum) & summary['population'].isin(populations)]
+    outliers = outliers[outliers['stratum'].astype(str) == stratum]
+
+    fig = Figure(figsize=(10, 6))
+    ax = fig.subplots()
+    pops = list(dict.fromkeys(summary['population']))
+    responses = sorted(summary['response'].unique())
+    width = 0.8 / max(len(responses), 1)
+    for j, response in enumerate(responses):
+        rows = summary[summary['response'] == response].set_index('population')
+        boxes, positions = [], []
+        for i, pop in enumerate(pops):
+            if pop not in rows.index:
+                continue
+            row = rows.loc[pop]
+            fliers = outliers[(outliers['population'] == pop) & (outliers['response'] == response)]['percentage']
+            boxes.append({'whislo': row['whisker_low'], 'q1': row['q1'], 'med': row['median'], 'q3': row['q3'],
+                          'whishi': row['whisker_high'], 'fliers': fliers.to_numpy(), 'label': pop})
+            positions.append(i - 0.4 + width * (j + 0.5))
+        if boxes:
+            ax.bxp(boxes, positions=positions, widths=width * 0.9, patch_artist=True,
+                   boxprops={'facecolor': f"C{j}"}, medianprops={'color': 'black'}, manage_ticks=False)
+        ax.plot([], [], 's', color=f"C{j}", label=response)
+    ax.set_xticks(range(len(pops)), pops, rotation=45)
+    ax.legend(title='response')
+    ax.set_title(title)
+    ax.set_ylabel("Relative Frequency (%)")
+    ax.set_xlabel("Cell Population")
+    fig.tight_layout()
+    return fig
+
+
+#One read-only connection pool and result cache shared by every session
+@st.cache_resource
+def get_data():
+    return DashboardData()
+
+
+#Instrumentation is started once per server process; every rerun records its page's render time
+@st.cache_resource
+def start_instrumentation():
+    instrumentation.start("dashboard")
+
+
+start_instrumentation()
+render_start = time.perf_counter()
 
-#Load and normalize all data
-relative_freq = pd.read_csv("Outputs/relative_frequencies.csv")
-relative_freq.columns = relative_freq.columns.str.strip().str.lower()
-
-mel_pbmcs = pd.read_csv("Outputs/mel_PBMC_samples_t0.csv")
-mel_pbmcs.columns = mel_pbmcs.columns.str.strip().str.lower()
-
-project_counts = pd.read_csv("Outputs/project_sample_nums.csv")
-response_counts = pd.read_csv("Outputs/response_subject_nums.csv")
-sex_counts = pd.read_csv("Outputs/sex_subject_nums.csv")
-
-cell_pops = pd.read_csv("Outputs/cell_pops_miraclib.csv")
-cell_pops.columns = cell_pops.columns.str.strip().str.lower()
-
-cp_time0 = pd.read_csv("Outputs/cp_time0.csv")
-cp_time0.columns = cp_time0.columns.str.strip().str.lower()
-cp_time7 = pd.read_csv("Outputs/cp_time7.csv")
-cp_time7.columns = cp_time7.columns.str.strip().str.lower()
-cp_time14 = pd.read_csv("Outputs/cp_time14.csv")
-cp_time14.columns = cp_time14.columns.str.strip().str.lower()
-
-stats_time0 = pd.read_csv("Outputs/stats_time0.csv")
-stats_time0.columns = stats_time0.columns.str.strip().str.lower()
-stats_time7 = pd.read_csv("Outputs/stats_time7.csv")
-stats_time7.columns = stats_time7.columns.str.strip().str.lower()
-stats_time14 = pd.read_csv("Outputs/stats_time14.csv")
-stats_time14.columns = stats_time14.columns.str.strip().str.lower()
-
-population_stats = pd.read_csv("Outputs/population_stats.csv")
-population_stats.columns = population_stats.columns.str.strip().str.lower()
 
 #Set the page configuration
 st.set_page_config(page_title="Loblaw Bio Clinical Trial Dashboard", layout="wide")
@@ -43,26 +106,47 @@ st.markdown("<h1 style='text-align: center;'>Loblaw Bio Clinical Trial Dashboard
 page = st.sidebar.radio("Navigate", [
     "Data Overview", 
     "Immune Response Statistics", 
-    "Subset Analysis"
+    "Subset Analysis",
+    "Cohort Explorer"
 ])
 
 #Page 1: Data Overview
 if page == "Data Overview":
     st.markdown("<h2 style='text-align: center;'>Immune Cell Population Frequencies per Sample</h2>", unsafe_allow_html=True)
 
-    sample_filter = st.multiselect("Filter by Sample ID:", options=relative_freq['sample_id'].unique())
-    pop_filter = st.multiselect("Filter by Population:", options=relative_freq['population'].unique())
-
-    filtered = relative_freq.copy()
-    if sample_filter:
-        filtered = filtered[filtered['sample_id'].isin(sample_filter)]
-    if pop_filter:
-        filtered = filtered[filtered['population'].isin(pop_filter)]
-
-    st.dataframe(filtered, use_container_width=True)
-
-    csv = filtered.to_csv(index=False).encode('utf-8')
-    st.download_button("Download Filtered Data", csv, "filtered_frequencies.csv", "text/csv")
+    #Filters are pushed down into SQL against the database instead of filtering the whole table in pandas
+    data = get_data()
+    sample_filter = st.multiselect("Filter by Sample ID:", options=data.sample_ids())
+    pop_filter = st.multiselect("Filter by Population:", options=data.populations())
+
+    #Only one page of rows is fetched per rerun; pages are keyed on the last (sample_id, population) shown
+    page_size = st.selectbox("Rows per page:", [100, 500, 1000], key="page_size")
+    filter_key = (tuple(sample_filter), tuple(pop_filter), page_size)
+    if st.session_state.get("page_filter") != filter_key:
+        st.session_state["page_filter"] = filter_key
+        st.session_state["page_starts"] = [None]
+    page_starts = st.session_state["page_starts"]
+
+    total_rows = data.count_relative_frequencies(sample_filter, pop_filter)
+    page_rows = data.relative_frequencies_page(sample_filter, pop_filter, page_starts[-1], page_size)
+
+    st.dataframe(page_rows, use_container_width=True)
+
+    prev_col, info_col, next_col = st.columns([1, 3, 1])
+    with prev_col:
+        if st.button("Previous", disabled=len(page_starts) == 1):
+            page_starts.pop()
+            st.rerun()
+    with info_col:
+        first_row = (len(page_starts) - 1) * page_size
+        st.markdown(f"Rows {first_row + 1 if total_rows else 0:,}-{first_row + len(page_rows):,} of {total_rows:,}")
+    with next_col:
+        if st.button("Next", disabled=first_row + len(page_rows) >= total_rows):
+            page_starts.append(tuple(page_rows.iloc[-1][['sample_id', 'population']]))
+            st.rerun()
+
+    #The CSV is only generated when the button is clicked
+    st.download_button("Download Filtered Data", lambda: data.export_relative_frequencies(sample_filter, pop_filter), "filtered_frequencies.csv", "text/csv")
 
 #Page 2: Immune Response Statistics
 elif page == "Immune Response Statistics":
@@ -73,28 +157,15 @@ elif page == "Immune Response Statistics":
     static_or_interactive = st.radio("View Type:", ["Interactive", "Static (from PNG)"], key="overall_view")
 
     if static_or_interactive == "Interactive":
-        overall_data = pd.concat([cp_time7, cp_time14])
-        pop_options = overall_data['population'].unique()
+        #Boxes come from the compact summaries written by stat_analysis.py ('pooled' = timepoints 7 and 14)
+        pop_options = load_table("Outputs/boxplot_summary.csv")['population'].unique()
         selected_pops = st.multiselect("Filter by Cell Population:", pop_options, default=list(pop_options), key="overall")
-        filtered_overall = overall_data[overall_data['population'].isin(selected_pops)]
-
-        fig, ax = plt.subplots(figsize=(10, 6))
-        sns.boxplot(
-            data=filtered_overall,
-            x="population",
-            y="percentage",
-            hue="response",
-            ax=ax
-        )
-        ax.set_title("Comparison of Relative Frequencies of Immune Cell Populations in Miraclib Responders vs. Non-Responders")
-        ax.set_ylabel("Relative Frequency (%)")
-        ax.set_xlabel("Cell Population")
-        plt.xticks(rotation=45)
+
+        fig = summary_boxplot("pooled", selected_pops, "Comparison of Relative Frequencies of Immune Cell Populations in Miraclib Responders vs. Non-Responders")
         st.pyplot(fig)
 
-        buf = io.BytesIO()
-        fig.savefig(buf, format="png")
-        st.download_button("Download Plot as PNG", buf.getvalue(), "overall_immune_response.png", "image/png")
+        #The PNG is only rendered when the button is clicked
+        st.download_button("Download Plot as PNG", lambda: png_bytes(fig), "overall_immune_response.png", "image/png")
     else:
         static_file = "Outputs/stats_boxplot.png"
         st.image(static_file, caption="Static Boxplot - Combined Timepoints")
@@ -102,7 +173,8 @@ elif page == "Immune Response Statistics":
             st.download_button("Download Static Plot", f, file_name=static_file, mime="image/png")
 
     st.subheader("Immune Response Summary T-Test Results")
-    st.dataframe(population_stats.style.applymap(lambda val: 'background-color: yellow' if isinstance(val, (float, int)) and val < 0.05 else '', subset=['p_value']), use_container_width=True)
+    population_stats = load_table("Outputs/population_stats.csv")
+    st.dataframe(population_stats.style.map(lambda val: 'background-color: yellow' if isinstance(val, (float, int)) and val < 0.05 else '', subset=['p_value']), use_container_width=True)
     st.markdown("<i>Analysis suggests that B-cells and CD4 T-cells have a significant difference in relative frequency between responders and non-responders. Respectively, p=0.011 < 0.05 and p=0.002 < 0.05 (given a significance level of 0.05,). No other populations showed significant differences.</i>", unsafe_allow_html=True)
 
     st.markdown("---")
@@ -111,8 +183,6 @@ elif page == "Immune Response Statistics":
     time_choice = st.selectbox("Select Timepoint:", options=[0, 7, 14])
     view_type = st.radio("View Type:", ["Interactive", "Static (from PNG)"], key=f"view_type_{time_choice}")
 
-    data_map = {0: cp_time0, 7: cp_time7, 14: cp_time14}
-    stats_map = {0: stats_time0, 7: stats_time7, 14: stats_time14}
     blurbs = {
         0: "Given a significance level of 0.05, analysis suggests that there is no significant difference in relative frequencies between responders and non-responders when time from treatment = 0.",
         7: "Analysis suggests that CD4 T-cells have a statistically significant difference in relative frequencies between responders and non-responders when time from treatment = 7. Given a significance level of 0.05, p=0.01 < 0.05.",
@@ -120,29 +190,13 @@ elif page == "Immune Response Statistics":
     }
 
     if view_type == "Interactive":
-        plot_data = data_map[time_choice]
-
-        pop_options = plot_data['population'].unique()
+        pop_options = load_table("Outputs/boxplot_summary.csv")['population'].unique()
         selected_pops = st.multiselect("Filter by Cell Population:", pop_options, default=list(pop_options), key=f"pops_{time_choice}")
-        filtered_plot_data = plot_data[plot_data['population'].isin(selected_pops)]
-
-        fig, ax = plt.subplots(figsize=(10, 6))
-        sns.boxplot(
-            data=filtered_plot_data,
-            x="population",
-            y="percentage",
-            hue="response",
-            ax=ax
-        )
-        ax.set_title(f"Frequencies of Immune Cell Populations in Miraclib Responders vs. Non-Responders when Time From Treatment = {time_choice}")
-        ax.set_ylabel("Relative Frequency (%)")
-        ax.set_xlabel("Cell Population")
-        plt.xticks(rotation=45)
+
+        fig = summary_boxplot(str(time_choice), selected_pops, f"Frequencies of Immune Cell Populations in Miraclib Responders vs. Non-Responders when Time From Treatment = {time_choice}")
         st.pyplot(fig)
 
-        buf = io.BytesIO()
-        fig.savefig(buf, format="png")
-        st.download_button("Download Plot as PNG", buf.getvalue(), f"timepoint_{time_choice}_plot.png", "image/png")
+        st.download_button("Download Plot as PNG", lambda: png_bytes(fig), f"timepoint_{time_choice}_plot.png", "image/png")
     else:
         static_map = {
             0: "Outputs/stats_boxplot_time0.png",
@@ -161,25 +215,27 @@ elif page == "Immune Response Statistics":
         except:
             return ''
 
-    stat_df = stats_map[time_choice].sort_values("p_value")
-    st.dataframe(stat_df.style.applymap(highlight_significant, subset=['p_value']), use_container_width=True)
+    stat_df = load_table(f"Outputs/stats_time{time_choice}.csv").sort_values("p_value")
+    st.dataframe(stat_df.style.map(highlight_significant, subset=['p_value']), use_container_width=True)
     st.markdown(f"<i>{blurbs[time_choice]}</i>", unsafe_allow_html=True)
 
     st.markdown("---")
     st.subheader("Download Source Tables")
 
+    #Files are read when their button is clicked, not on every rerun of the page
+
     col1, col2, col3 = st.columns(3)
 
     with col1:
         st.download_button(
             "Download Overall Response Data",
-            cell_pops.to_csv(index=False).encode('utf-8'),
+            lambda: load_bytes("Outputs/cell_pops_miraclib.csv"),
             "cell_pops_miraclib.csv",
             "text/csv"
         )
         st.download_button(
             "Download Overall Response Stats",
-            population_stats.to_csv(index=False).encode('utf-8'),
+            lambda: load_bytes("Outputs/population_stats.csv"),
             "population_stats.csv",
             "text/csv"
         )
@@ -187,13 +243,13 @@ elif page == "Immune Response Statistics":
     with col2:
         st.download_button(
             "Download Timepoint 0 Data",
-            cp_time0.to_csv(index=False).encode('utf-8'),
+            lambda: load_bytes("Outputs/cp_time0.csv"),
             "cp_time0.csv",
             "text/csv"
         )
         st.download_button(
             "Download Timepoint 0 Stats",
-            stats_time0.to_csv(index=False).encode('utf-8'),
+            lambda: load_bytes("Outputs/stats_time0.csv"),
             "stats_time0.csv",
             "text/csv"
         )
@@ -201,25 +257,25 @@ elif page == "Immune Response Statistics":
     with col3:
         st.download_button(
             "Download Timepoint 7 Data",
-            cp_time7.to_csv(index=False).encode('utf-8'),
+            lambda: load_bytes("Outputs/cp_time7.csv"),
             "cp_time7.csv",
             "text/csv"
         )
         st.download_button(
             "Download Timepoint 7 Stats",
-            stats_time7.to_csv(index=False).encode('utf-8'),
+            lambda: load_bytes("Outputs/stats_time7.csv"),
             "stats_time7.csv",
             "text/csv"
         )
         st.download_button(
             "Download Timepoint 14 Data",
-            cp_time14.to_csv(index=False).encode('utf-8'),
+            lambda: load_bytes("Outputs/cp_time14.csv"),
             "cp_time14.csv",
             "text/csv"
         )
         st.download_button(
             "Download Timepoint 14 Stats",
-            stats_time14.to_csv(index=False).encode('utf-8'),
+            lambda: load_bytes("Outputs/stats_time14.csv"),
             "stats_time14.csv",
             "text/csv"
         )
@@ -238,26 +294,68 @@ elif page == "Subset Analysis":
     table = None
     query_heading = ""
     filename = ""
+    source = None
 
     if query_choice == "Baseline melanoma PBMC samples treated with miraclib":
         query_heading = "Identify all melanoma PBMC samples at baseline (time_from_treatment_start = 0) from patients treated with miraclib:"
-        table = mel_pbmcs
+        source = "Outputs/mel_PBMC_samples_t0.csv"
         filename = "mel_pbmcs.csv"
     elif query_choice == "How many samples from each project?":
-        table = project_counts
+        source = "Outputs/project_sample_nums.csv"
         filename = "project_counts.csv"
     elif query_choice == "How many subjects were responders/non-responders?":
-        table = response_counts
+        source = "Outputs/response_subject_nums.csv"
         filename = "response_counts.csv"
     elif query_choice == "How many subjects were males/females?":
-        table = sex_counts
+        source = "Outputs/sex_subject_nums.csv"
         filename = "sex_counts.csv"
 
-    if table is not None:
+    if source is not None:
+        table = load_table(source)
         if query_heading:
             st.markdown(f"**{query_heading}**")
         st.dataframe(table, use_container_width=True)
-        csv = table.to_csv(index=False).encode('utf-8')
-        st.download_button("Download This Table", csv, filename, "text/csv")
+        st.download_button("Download This Table", lambda: load_bytes(source), filename, "text/csv")
+
+#Page 4: Cohort Explorer
+elif page == "Cohort Explorer":
+    st.markdown("<h2 style='text-align: center;'>Cohort Explorer</h2>", unsafe_allow_html=True)
+    st.markdown("Responder vs. non-responder comparisons for any cohort, computed from the per-group sums kept in the `stats_cube` table, so no sample rows are read.")
+    from stat_tests import cube_moments, welch_ttests
+
+    #A few hundred rows of n / sum / sum of squares per (condition, treatment, sample type, timepoint, response, population)
+    cube = get_data().stats_cube()
+    dimensions = {
+        'condition': ("Condition:", ['melanoma']),
+        'treatment': ("Treatment:", ['miraclib']),
+        'sample_type': ("Sample Type:", ['PBMC']),
+        'time_from_treatment_start': ("Time from Treatment:", [7, 14]),
+    }
+
+    selected = {}
+    for col, (column, (label, default)) in zip(st.columns(len(dimensions)), dimensions.items()):
+        options = sorted(cube[column].unique())
+        with col:
+            selected[column] = st.multiselect(label, options, default=[value for value in default if value in options], key=f"cube_{column}")
+    by = st.multiselect("Compare within each:", ['population'] + list(dimensions), default=['population'])
+
+    sliced = cube
+    for column, values in selected.items():
+        sliced = sliced[sliced[column].isin(values)]
+
+    if not by:
+        st.info("Choose at least one dimension to compare within.")
+    elif sliced.empty:
+        st.info("No samples match this selection.")
+    else:
+        moments = cube_moments(sliced, by)
+        sizes = moments.pivot_table(index=by, columns='response', values='n', aggfunc='sum', observed=True)
+        results = welch_ttests(moments, by)
+        for response in ['yes', 'no']:
+            if response in sizes:
+                results = results.merge(sizes[response].rename(f"n_{response}").reset_index(), on=by, how='left')
+        st.dataframe(results.style.map(lambda val: 'background-color: yellow' if isinstance(val, float) and val < 0.05 else '', subset=['p_value']), use_container_width=True)
+        st.markdown("<i>Welch's t-tests of the relative frequencies of responders (n_yes samples) vs. non-responders (n_no samples), pooling every selected value of the dimensions not compared within.</i>", unsafe_allow_html=True)
 
 st.markdown("---")
+instrumentation.record('page', page, seconds=round(time.perf_counter() - render_start, 6))
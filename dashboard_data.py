@@ -0,0 +1,115 @@
+'''Dashboard data access: live read-only queries against loblawbio.db'''
+
+import csv
+import io
+import os
+import queue
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+
+import pandas as pd
+
+import instrumentation
+import queries
+
+database = "Outputs/loblawbio.db"
+
+
+class ConnectionPool:
+    '''A fixed number of read-only SQLite connections shared by every dashboard session and thread.'''
+
+    def __init__(self, path=database, size=4):
+        self.uri = f"file:{os.path.abspath(path)}?mode=ro"
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def _open(self):
+        #check_same_thread is off because a connection may serve different threads, but never two at once
+        con = instrumentation.connect(self.uri, uri=True, check_same_thread=False)
+        con.execute("PRAGMA query_only = ON")
+        return con
+
+    @contextmanager
+    def connection(self):
+        '''Borrow a connection, opening a new one while the pool is below its size, otherwise waiting for one.'''
+        try:
+            con = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                grow = self._opened < self.size
+                if grow:
+                    self._opened += 1
+            con = self._open() if grow else self._idle.get()
+        try:
+            yield con
+        finally:
+            self._idle.put(con)
+
+
+class DashboardData:
+    '''Parameterized queries for the dashboard, with results kept in a bounded LRU cache.
+
+    Results are shared between sessions, so callers must treat the returned frames as read-only.
+    Cache keys include the modification times of the database and its WAL file, so publishing a load invalidates them.
+    '''
+
+    def __init__(self, path=database, pool_size=4, cache_size=64):
+        self.path = path
+        self.pool = ConnectionPool(path, pool_size)
+        self._cached_query = lru_cache(maxsize=cache_size)(self._query)
+
+    def _query(self, sql, params, version):
+        with self.pool.connection() as con:
+            return pd.read_sql_query(sql, con, params=params)
+
+    def version(self):
+        '''Changes whenever a load is published: the database is in WAL mode, so commits land in the -wal file first.'''
+        wal = self.path + "-wal"
+        return os.path.getmtime(self.path), os.path.getmtime(wal) if os.path.exists(wal) else None
+
+    def query(self, sql, params=()):
+        return self._cached_query(sql, tuple(params), self.version())
+
+    def sample_ids(self):
+        return self.query(queries.sample_ids)['sample_id']
+
+    def populations(self):
+        return self.query(queries.populations)['population']
+
+    def stats_cube(self):
+        return self.query(queries.stats_cube)
+
+    def count_relative_frequencies(self, samples=(), populations=()):
+        sql = queries.count_relative_frequencies(len(samples), len(populations))
+        return int(self.query(sql, list(samples) + list(populations))['row_count'].iloc[0])
+
+    def relative_frequencies_page(self, samples=(), populations=(), after=None, limit=100):
+        '''One page of relative frequencies filtered in SQL, starting after the (sample_id, population) key.'''
+        sql = queries.filtered_relative_frequencies(len(samples), len(populations), keyset=after is not None, limit=True)
+        params = list(samples) + list(populations) + (list(after) if after is not None else []) + [limit]
+        return self.query(sql, params)
+
+    def export_relative_frequencies(self, samples=(), populations=(), chunk_rows=50000):
+        '''The filtered relative frequencies as CSV bytes, for the download button.
+
+        Streamlit keeps the whole download in memory, so the CSV is built in memory too; rows are fetched
+        chunk_rows at a time so the result is never also held as one list of row tuples.
+        '''
+        sql = queries.filtered_relative_frequencies(len(samples), len(populations))
+        out = io.BytesIO()
+        text = io.TextIOWrapper(out, encoding="utf-8", newline="")
+        writer = csv.writer(text)
+        with self.pool.connection() as con:
+            cur = con.execute(sql, list(samples) + list(populations))
+            writer.writerow([d[0] for d in cur.description])
+            while True:
+                rows = cur.fetchmany(chunk_rows)
+                if not rows:
+                    break
+                writer.writerows(rows)
+        text.flush()
+        text.detach()
+        return out.getvalue()
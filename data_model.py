@@ -0,0 +1,133 @@
+'''Data model: cell counts as a samples x populations matrix with categorical sample metadata'''
+
+import numpy as np
+import pandas as pd
+
+#Columns of the long format that are derived from the counts rather than describing the sample
+count_columns = ['total_count', 'population', 'count', 'percentage']
+
+
+def integer_counts(values):
+    '''Counts as an int64 array, raising ValueError if any is missing, negative or fractional (NaN must never be cast to an integer).'''
+    values = np.asarray(values)
+    if values.dtype.kind in 'iu':
+        if (values < 0).any():
+            raise ValueError("cell counts must be non-negative integers")
+        return values.astype(np.int64, copy=False)
+    values = values.astype(float)
+    if np.isnan(values).any() or (values < 0).any() or (values % 1 != 0).any():
+        raise ValueError("cell counts must be non-negative integers")
+    return values.astype(np.int64)
+
+
+def categorize(samples, id_column='sample_id'):
+    '''Store every text column except the sample id as a categorical (integer codes plus one copy of each value).'''
+    samples = samples.copy()
+    for column in samples.columns:
+        if column != id_column and (samples[column].dtype == object or pd.api.types.is_string_dtype(samples[column])):
+            samples[column] = samples[column].astype('category')
+    return samples
+
+
+class CellMatrix:
+    '''Cell counts as a dense samples x populations integer matrix, with one row of metadata per sample.
+
+    The long format repeats a sample's metadata once for every population; here it is stored once per
+    sample, text columns as categoricals, and the counts live in a single NumPy array. Row i of counts
+    belongs to row i of samples, column j to populations[j].
+    '''
+
+    def __init__(self, samples, populations, counts):
+        self.samples = samples.reset_index(drop=True)
+        self.populations = pd.Index(populations, name='population')
+        self.counts = counts
+
+    @classmethod
+    def from_wide(cls, df, populations, id_column='sample_id'):
+        '''Build from a frame with one row per sample and one count column per population (the CSV layout).
+
+        Samples keep their order; populations are sorted, as in from_long.
+        '''
+        populations = sorted(populations)
+        counts = integer_counts(df[populations].to_numpy())
+        return cls(categorize(df.drop(columns=populations), id_column), populations, counts)
+
+    @classmethod
+    def from_long(cls, df, id_column='sample_id'):
+        '''Build from long rows (one per sample and population), e.g. a query result.
+
+        Samples and populations are sorted; columns other than the count columns are per-sample metadata,
+        taken from each sample's first row. A population missing for a sample counts as 0.
+        '''
+        sample_codes, sample_ids = pd.factorize(df[id_column], sort=True)
+        population_codes, populations = pd.factorize(df['population'], sort=True)
+        counts = np.zeros((len(sample_ids), len(populations)), dtype=np.int64)
+        counts[sample_codes, population_codes] = integer_counts(df['count'].to_numpy())
+
+        #Position of the first row of every sample (assigning in reverse leaves the earliest row standing)
+        first = np.empty(len(sample_ids), dtype=np.intp)
+        first[sample_codes[::-1]] = np.arange(len(df))[::-1]
+        samples = df[[col for col in df.columns if col not in count_columns]].iloc[first]
+        return cls(categorize(samples, id_column), populations, counts)
+
+    @property
+    def totals(self):
+        return self.counts.sum(axis=1)
+
+    def frequencies(self):
+        '''Relative frequency (%) of every population in every sample, as one vectorized row normalization.'''
+        totals = self.totals
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(totals[:, None] > 0, 100 * self.counts / totals[:, None], np.nan)
+
+    def trajectories(self, subject_column='subject_id', time_column='time_from_treatment_start'):
+        '''Relative frequencies as a dense subjects x timepoints x populations array, built in one scatter.
+
+        Returns (subjects, timepoints, values, observed). values is NaN and observed False wherever a
+        subject has no sample at a timepoint, so gaps are masked rather than merged around. Subjects and
+        timepoints are sorted; if a subject has two samples at one timepoint the last one in row order is kept.
+        '''
+        subject_codes, subjects = pd.factorize(self.samples[subject_column], sort=True)
+        time_codes, timepoints = pd.factorize(self.samples[time_column], sort=True)
+        #Repeated indices in a fancy assignment have no defined winner, so duplicates are dropped first
+        keep = ~pd.Series(subject_codes * len(timepoints) + time_codes).duplicated(keep='last').to_numpy()
+        subject_codes, time_codes = subject_codes[keep], time_codes[keep]
+        values = np.full((len(subjects), len(timepoints), len(self.populations)), np.nan)
+        values[subject_codes, time_codes] = self.frequencies()[keep]
+        observed = np.zeros(values.shape[:2], dtype=bool)
+        observed[subject_codes, time_codes] = True
+        return np.asarray(subjects), np.asarray(timepoints), values, observed
+
+    def to_long(self, percentages=True):
+        '''Long frame in (sample, population) order: the sample metadata, total_count, population, count
+        and, with percentages=True, percentage.'''
+        n_samples, n_populations = self.counts.shape
+        rows = np.repeat(np.arange(n_samples), n_populations)
+        long = self.samples.iloc[rows].reset_index(drop=True)
+        long['total_count'] = np.repeat(self.totals, n_populations)
+        long['population'] = pd.Categorical.from_codes(np.tile(np.arange(n_populations), n_samples), categories=self.populations)
+        long['count'] = self.counts.ravel()
+        if percentages:
+            long['percentage'] = self.frequencies().ravel()
+        return long
+
+    def take(self, rows):
+        '''The matrix of a subset of samples, given as a boolean mask or positions.'''
+        rows = np.flatnonzero(rows) if np.asarray(rows).dtype == bool else np.asarray(rows)
+        return CellMatrix(self.samples.iloc[rows], self.populations, self.counts[rows])
+
+    def iter_long(self, chunk_samples, percentages=True):
+        '''to_long in consecutive frames of chunk_samples samples, so only one frame's rows are expanded at a time.'''
+        for start in range(0, max(len(self.samples), 1), chunk_samples):
+            yield self.take(np.arange(start, min(start + chunk_samples, len(self.samples)))).to_long(percentages)
+
+    def memory_usage(self):
+        '''Bytes held by the matrix and the sample metadata.'''
+        return int(self.counts.nbytes + self.samples.memory_usage(deep=True).sum())
+
+
+def memory_report(label, frame, matrix):
+    '''One line comparing the memory of a long-format frame with the matrix holding the same data.'''
+    frame_bytes = int(frame.memory_usage(deep=True).sum())
+    matrix_bytes = matrix.memory_usage()
+    return f"{label}: long frame {frame_bytes / 1e6:.2f} MB, count matrix {matrix_bytes / 1e6:.2f} MB ({frame_bytes / matrix_bytes:.1f}x smaller)"
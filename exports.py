@@ -0,0 +1,111 @@
+'''Output tables: CSV (plain or compressed), optionally alongside a typed, categorical Parquet copy'''
+
+import bz2
+import gzip
+import lzma
+import os
+
+import pandas as pd
+
+try:
+    import pyarrow
+except ImportError:
+    #Optional, without it only the CSVs are written
+    pyarrow = None
+else:
+    import pyarrow.parquet
+
+#Low-cardinality text columns stored as dictionary-encoded categoricals in Parquet
+categorical_columns = {'population', 'response', 'sex', 'condition', 'treatment', 'sample_type', 'project', 'stratum'}
+
+#Compressed CSV variants, chosen by the output file's extension
+compressors = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+
+#Rows fetched from a cursor (or written from a frame) per batch when streaming an export
+chunk_rows = 50000
+
+
+def parquet_path(csv_path):
+    root, ext = os.path.splitext(csv_path)
+    if ext in compressors:
+        root = os.path.splitext(root)[0]
+    return root + ".parquet"
+
+
+def open_output(path):
+    '''Open path for writing CSV text, compressed if it ends in .gz, .bz2 or .xz.'''
+    opener = compressors.get(os.path.splitext(path)[1], open)
+    return opener(path, "wt", encoding="utf-8", newline="")
+
+
+def typed(df):
+    '''Copy of df with the categorical columns converted, for writing to Parquet.'''
+    df = df.copy()
+    for column in categorical_columns & set(df.columns):
+        df[column] = df[column].astype('category')
+    return df
+
+
+def write_table(df, csv_path, parquet=False):
+    '''Write df to csv_path and, with parquet=True, to a Parquet file next to it.
+
+    Without parquet any Parquet copy left by an earlier run is removed, so readers that prefer Parquet
+    never pick up a stale table.
+    '''
+    df.to_csv(csv_path, index=False)
+    if parquet:
+        typed(df).to_parquet(parquet_path(csv_path), index=False)
+    elif os.path.exists(parquet_path(csv_path)):
+        os.remove(parquet_path(csv_path))
+
+
+def write_frames(frames, csv_path, parquet=False):
+    '''Write frames with the same columns to csv_path one at a time, as if they were one table; returns the row count.
+
+    Only the frame being written is held in memory, and the CSV grows from the first frame on. With
+    parquet=True every frame also becomes a row group of the Parquet copy, converted to the schema of
+    the first one; without it a stale Parquet copy is removed, as in write_table.
+    '''
+    writer = None
+    rows = 0
+    try:
+        with open_output(csv_path) as f:
+            for i, frame in enumerate(frames):
+                frame.to_csv(f, header=i == 0, index=False)
+                rows += len(frame)
+                if parquet:
+                    table = pyarrow.Table.from_pandas(typed(frame), schema=writer.schema if writer else None, preserve_index=False)
+                    writer = writer or pyarrow.parquet.ParquetWriter(parquet_path(csv_path), table.schema)
+                    writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+    if not parquet and os.path.exists(parquet_path(csv_path)):
+        os.remove(parquet_path(csv_path))
+    return rows
+
+
+def fetch_frames(cur, size=chunk_rows):
+    '''Frames of fetchmany(size) rows from an executed cursor; always at least one, so an empty result still has its header.'''
+    columns = [d[0] for d in cur.description]
+    rows = cur.fetchmany(size)
+    yield pd.DataFrame.from_records(rows, columns=columns)
+    while rows:
+        rows = cur.fetchmany(size)
+        if rows:
+            yield pd.DataFrame.from_records(rows, columns=columns)
+
+
+def export_query(cur, csv_path, parquet=False, size=chunk_rows):
+    '''Stream an executed cursor's result into csv_path (and its Parquet copy) in batches of size rows.
+
+    Export memory stays at one batch however large the result is. Returns the row count.
+    '''
+    return write_frames(fetch_frames(cur, size), csv_path, parquet)
+
+
+def read_table(csv_path):
+    '''Read an output table, from its Parquet copy when there is one.'''
+    if pyarrow is not None and os.path.exists(parquet_path(csv_path)):
+        return pd.read_parquet(parquet_path(csv_path))
+    return pd.read_csv(csv_path)
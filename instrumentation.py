@@ -0,0 +1,159 @@
+'''Instrumentation: timing spans, row counts and SQLite statement timings, written as a JSON lines report
+
+Every script calls start() once. Spans are appended to Outputs/instrumentation.jsonl as they finish,
+statement totals (per SQL text: calls, seconds executing and fetching, rows) when the script exits.
+Setting LOBLAW_PROFILE to "cprofile", "tracemalloc" or both (comma separated) also captures a cProfile
+dump (Outputs/profile_<script>.prof) and the peak traced memory with its top allocation sites.
+'''
+
+import atexit
+import cProfile
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+report_path = "Outputs/instrumentation.jsonl"
+profile_flag = "LOBLAW_PROFILE"
+
+_state = {'script': None, 'run': None, 'profiler': None}
+_statements = {}
+_lock = threading.Lock()
+
+
+def record(kind, name, **fields):
+    '''Append one event to the report.'''
+    event = {'run': _state['run'], 'script': _state['script'], 'kind': kind, 'name': name, **fields}
+    line = json.dumps(event, default=str) + "\n"
+    #A report that can't be written (e.g. a read-only deployment) must never break the script being measured
+    try:
+        with _lock:
+            with open(report_path, "a") as f:
+                f.write(line)
+    except OSError:
+        pass
+
+
+@contextmanager
+def span(name, **fields):
+    '''Time the block as a named span; fields (e.g. rows) can be set on the yielded dict inside the block.'''
+    fields = dict(fields)
+    start = time.perf_counter()
+    try:
+        yield fields
+    finally:
+        record('span', name, seconds=round(time.perf_counter() - start, 6), **fields)
+
+
+def _add_statement(sql, seconds, rows=0, calls=1):
+    key = re.sub(r"\s+", " ", sql).strip()
+    with _lock:
+        total_calls, total, total_rows = _statements.get(key, (0, 0.0, 0))
+        _statements[key] = (total_calls + calls, total + seconds, total_rows + max(rows, 0))
+
+
+class TimedCursor(sqlite3.Cursor):
+    '''Cursor that adds the time spent executing and fetching to its statement's running totals.'''
+
+    def execute(self, sql, parameters=()):
+        self._sql = sql
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _add_statement(sql, time.perf_counter() - start, self.rowcount)
+
+    def executemany(self, sql, seq_of_parameters):
+        self._sql = sql
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _add_statement(sql, time.perf_counter() - start, self.rowcount)
+
+    def executescript(self, sql_script):
+        start = time.perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            _add_statement(sql_script, time.perf_counter() - start)
+
+    def _fetch(self, fetch, *args):
+        start = time.perf_counter()
+        rows = fetch(*args)
+        #Fetched rows are counted here; the call itself was already counted by execute
+        _add_statement(getattr(self, '_sql', ''), time.perf_counter() - start, len(rows), calls=0)
+        return rows
+
+    def fetchall(self):
+        return self._fetch(super().fetchall)
+
+    def fetchmany(self, size=None):
+        return self._fetch(super().fetchmany, self.arraysize if size is None else size)
+
+
+class TimedConnection(sqlite3.Connection):
+    '''Connection whose cursors (including the implicit ones of execute/executemany) are TimedCursors.'''
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+
+def connect(database, **kwargs):
+    '''sqlite3.connect with statement timing.'''
+    return sqlite3.connect(database, factory=TimedConnection, **kwargs)
+
+
+def start(script):
+    '''Begin instrumenting a script run; the statement totals and profiles are written when the interpreter exits.'''
+    _state['script'] = script
+    _state['run'] = f"{datetime.now(timezone.utc).isoformat(timespec='seconds')}-{os.getpid()}"
+    _state['start'] = time.perf_counter()
+    flags = {flag.strip() for flag in os.environ.get(profile_flag, "").lower().split(",")}
+    if 'tracemalloc' in flags:
+        tracemalloc.start(10)
+    if 'cprofile' in flags:
+        _state['profiler'] = cProfile.Profile()
+        _state['profiler'].enable()
+    atexit.register(finish)
+
+
+def finish():
+    '''Write the statement totals, the profiles if enabled, and the total run time to the report.'''
+    if _state['script'] is None:
+        return
+    with _lock:
+        statements = sorted(_statements.items(), key=lambda item: -item[1][1])
+        _statements.clear()
+    for sql, (calls, seconds, rows) in statements:
+        record('statement', sql, calls=calls, seconds=round(seconds, 6), rows=rows)
+
+    if _state['profiler'] is not None:
+        _state['profiler'].disable()
+        path = f"Outputs/profile_{_state['script']}.prof"
+        _state['profiler'].dump_stats(path)
+        record('profile', 'cprofile', path=path)
+        _state['profiler'] = None
+    if tracemalloc.is_tracing():
+        _, peak = tracemalloc.get_traced_memory()
+        top = tracemalloc.take_snapshot().statistics('lineno')[:10]
+        tracemalloc.stop()
+        record('profile', 'tracemalloc', peak_mb=round(peak / 1e6, 2),
+               top_at_exit=[{'where': str(stat.traceback), 'mb': round(stat.size / 1e6, 3)} for stat in top])
+
+    record('span', 'total', seconds=round(time.perf_counter() - _state['start'], 6))
+    _state['script'] = None
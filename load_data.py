@@ -1,36 +1,59 @@
 '''Part 1: Data Management'''
 
+import argparse
+import glob
+import hashlib
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import groupby
+from operator import itemgetter
+
 import pandas as pd
-import sqlite3
+
+import instrumentation
+from data_model import CellMatrix, memory_report
+
+try:
+    import resource
+except ImportError:
+    #Not available on Windows, peak memory is simply not reported there
+    resource = None
 
 csv = "cell-count.csv"
 database = "Outputs/loblawbio.db"
 
-#Load cell_count.csv into a Data Frame
-df = pd.read_csv(csv)
+cell_columns = ['b_cell', 'cd8_t_cell', 'cd4_t_cell', 'nk_cell', 'monocyte']
+
+#Columns every input CSV must have
+csv_columns = ['project', 'subject', 'condition', 'age', 'sex', 'treatment', 'response', 'sample', 'sample_type', 'time_from_treatment_start'] + cell_columns
 
-#Split csv data into tables
-subjects = df[['subject', 'condition', 'age', 'sex', 'treatment', 'response']].drop_duplicates()
-subjects.columns = ['subject_id', 'condition', 'age', 'sex',  'treatment', 'response']
+#CSV columns holding numbers; every other column is text
+numeric_columns = ['age', 'time_from_treatment_start'] + cell_columns
 
-samples = df[['sample', 'subject', 'project', 'sample_type', 'time_from_treatment_start']].drop_duplicates()
-samples.columns = ['sample_id', 'subject_id', 'project', 'sample_type', 'time_from_treatment_start']
+#Number of rows handed to each executemany call
+batch_size = 50000
 
-cell_columns = ['b_cell', 'cd8_t_cell', 'cd4_t_cell', 'nk_cell', 'monocyte']
-cell_counts = df[['sample'] + cell_columns].melt(id_vars='sample', var_name='population', value_name='count')
-cell_counts.columns = ['sample_id', 'population', 'count']
+#Number of CSV rows read per chunk in streaming mode
+chunk_size = 100000
 
-#Connect to the SQLite database
-con = sqlite3.connect(database)
-cur = con.cursor()
+#SQLite page cache (KB) for streaming loads, which must not grow with the size of the database
+stream_cache_kb = 8000
 
-#Make tables
-cur.executescript("""
+drop_tables = """
 DROP TABLE IF EXISTS cell_counts;
 DROP TABLE IF EXISTS samples;
 DROP TABLE IF EXISTS subjects;
+DROP TABLE IF EXISTS sample_totals;
+DROP TABLE IF EXISTS sample_hashes;
+DROP TABLE IF EXISTS load_ledger;
+DROP TABLE IF EXISTS stats_cube;
+"""
 
-CREATE TABLE subjects (
+create_tables = """
+CREATE TABLE IF NOT EXISTS subjects (
     subject_id TEXT PRIMARY KEY,
     condition TEXT,
     age INTEGER,
@@ -39,7 +62,7 @@ CREATE TABLE subjects (
     response TEXT
 );
 
-CREATE TABLE samples (
+CREATE TABLE IF NOT EXISTS samples (
     sample_id TEXT PRIMARY KEY,
     subject_id TEXT,
     project TEXT,
@@ -48,30 +71,666 @@ CREATE TABLE samples (
     FOREIGN KEY (subject_id) REFERENCES subjects(subject_id)
 );
 
-CREATE TABLE cell_counts (
+CREATE TABLE IF NOT EXISTS cell_counts (
     sample_id TEXT,
     population TEXT,
     count INTEGER,
     PRIMARY KEY (sample_id, population),
     FOREIGN KEY (sample_id) REFERENCES samples(sample_id)
 );
-""")
 
-#Insert data into tables
-# Subjects
-for _, row in subjects.iterrows():
-    cur.execute("INSERT OR IGNORE INTO subjects (subject_id, condition, age, sex, treatment, response) VALUES (?, ?, ?, ?, ?, ?)", tuple(row))
+CREATE TABLE IF NOT EXISTS sample_totals (
+    sample_id TEXT PRIMARY KEY,
+    total_count INTEGER,
+    FOREIGN KEY (sample_id) REFERENCES samples(sample_id)
+);
+
+CREATE TABLE IF NOT EXISTS sample_hashes (
+    sample_id TEXT PRIMARY KEY,
+    row_hash INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS load_ledger (
+    fingerprint TEXT PRIMARY KEY,
+    source TEXT,
+    rows INTEGER,
+    loaded_at TEXT
+);
+
+CREATE TABLE IF NOT EXISTS stats_cube (
+    condition TEXT,
+    treatment TEXT,
+    sample_type TEXT,
+    time_from_treatment_start INTEGER,
+    response TEXT,
+    population TEXT,
+    n INTEGER,
+    sum_percentage REAL,
+    sumsq_percentage REAL,
+    PRIMARY KEY (condition, treatment, sample_type, time_from_treatment_start, response, population)
+);
+"""
+
+schema = drop_tables + create_tables
+
+#Secondary indexes are built once the data has landed so inserts don't maintain them row by row
+#They match the analysis queries (see queries.py): subjects are filtered on condition/treatment, then
+#samples are reached through subject_id and filtered on sample_type/time_from_treatment_start.
+#The trailing columns make both indexes covering for the subset analysis counts.
+#The dashboard filters cell counts on population alone, paging in sample_id order and counting the matches.
+indexes = [
+    "CREATE INDEX IF NOT EXISTS idx_subjects_cohort ON subjects (condition, treatment, subject_id, response, sex, age)",
+    "CREATE INDEX IF NOT EXISTS idx_samples_cohort ON samples (subject_id, sample_type, time_from_treatment_start, sample_id, project)",
+    "CREATE INDEX IF NOT EXISTS idx_cell_counts_population ON cell_counts (population, sample_id)",
+    "ANALYZE",
+]
+
+insert_sql = {
+    'subjects': "INSERT OR IGNORE INTO subjects (subject_id, condition, age, sex, treatment, response) VALUES (?, ?, ?, ?, ?, ?)",
+    'samples': "INSERT OR IGNORE INTO samples (sample_id, subject_id, project, sample_type, time_from_treatment_start) VALUES (?, ?, ?, ?, ?)",
+    'cell_counts': "INSERT OR IGNORE INTO cell_counts (sample_id, population, count) VALUES (?, ?, ?)",
+    'sample_totals': "INSERT OR IGNORE INTO sample_totals (sample_id, total_count) VALUES (?, ?)",
+    'sample_hashes': "INSERT OR IGNORE INTO sample_hashes (sample_id, row_hash) VALUES (?, ?)",
+}
+
+#Adds sign x (n, sum, sum of squares) of the percentages of the samples matched by a WHERE clause to the
+#cube cells they fall in; subjects without a response (healthy donors) are filed under 'none'
+cube_delta_sql = """
+INSERT INTO stats_cube (condition, treatment, sample_type, time_from_treatment_start, response, population, n, sum_percentage, sumsq_percentage)
+SELECT su.condition, su.treatment, sa.sample_type, sa.time_from_treatment_start, COALESCE(su.response, 'none'), cc.population,
+       {sign} * COUNT(*), {sign} * SUM(CAST(100.0 * cc.count AS FLOAT) / totals.total_count),
+       {sign} * SUM((CAST(100.0 * cc.count AS FLOAT) / totals.total_count) * (CAST(100.0 * cc.count AS FLOAT) / totals.total_count))
+FROM cell_counts cc
+JOIN sample_totals totals ON cc.sample_id = totals.sample_id
+JOIN samples sa ON cc.sample_id = sa.sample_id
+JOIN subjects su ON sa.subject_id = su.subject_id
+WHERE {where}
+GROUP BY su.condition, su.treatment, sa.sample_type, sa.time_from_treatment_start, COALESCE(su.response, 'none'), cc.population
+ON CONFLICT (condition, treatment, sample_type, time_from_treatment_start, response, population) DO UPDATE SET
+    n = n + excluded.n, sum_percentage = sum_percentage + excluded.sum_percentage, sumsq_percentage = sumsq_percentage + excluded.sumsq_percentage
+"""
+
+#Incremental loads overwrite rows whose content changed instead of ignoring them
+upsert_sql = {
+    'subjects': insert_sql['subjects'].replace("INSERT OR IGNORE", "INSERT") + " ON CONFLICT (subject_id) DO UPDATE SET condition = excluded.condition, age = excluded.age, sex = excluded.sex, treatment = excluded.treatment, response = excluded.response",
+    'samples': insert_sql['samples'].replace("INSERT OR IGNORE", "INSERT") + " ON CONFLICT (sample_id) DO UPDATE SET subject_id = excluded.subject_id, project = excluded.project, sample_type = excluded.sample_type, time_from_treatment_start = excluded.time_from_treatment_start",
+    'cell_counts': insert_sql['cell_counts'].replace("INSERT OR IGNORE", "INSERT") + " ON CONFLICT (sample_id, population) DO UPDATE SET count = excluded.count",
+    'sample_totals': insert_sql['sample_totals'].replace("INSERT OR IGNORE", "INSERT") + " ON CONFLICT (sample_id) DO UPDATE SET total_count = excluded.total_count",
+    'sample_hashes': insert_sql['sample_hashes'].replace("INSERT OR IGNORE", "INSERT") + " ON CONFLICT (sample_id) DO UPDATE SET row_hash = excluded.row_hash",
+}
+
+
+def row_hashes(df):
+    '''Content hash of every CSV row that doesn't depend on the dtypes pandas inferred for the chunk.
+
+    Numeric columns are hashed as float64 and text columns as strings with blanks as '', so a chunk of
+    healthy donors only (whose all-blank response column is read as float) hashes like any other.
+    '''
+    canonical = pd.DataFrame({
+        col: df[col].astype('float64') if col in numeric_columns else df[col].astype(object).where(df[col].notna(), '').astype(str)
+        for col in df.columns
+    })
+    return pd.util.hash_pandas_object(canonical, index=False).astype('int64')
+
+
+def split_tables(df, report=False):
+    '''Split the wide cell-count frame into a {table name: frame} dict, in insert order.
+
+    With report=True the memory of the melted cell_counts frame is printed against the count matrix.
+    '''
+    subjects = df[['subject', 'condition', 'age', 'sex', 'treatment', 'response']].drop_duplicates()
+    subjects.columns = ['subject_id', 'condition', 'age', 'sex',  'treatment', 'response']
+
+    samples = df[['sample', 'subject', 'project', 'sample_type', 'time_from_treatment_start']].drop_duplicates()
+    samples.columns = ['sample_id', 'subject_id', 'project', 'sample_type', 'time_from_treatment_start']
+
+    matrix = CellMatrix.from_wide(df[['sample'] + cell_columns].rename(columns={'sample': 'sample_id'}), cell_columns)
+    cell_counts = matrix.to_long(percentages=False)[['sample_id', 'population', 'count']]
+    if report:
+        print(memory_report("Cell counts", cell_counts, matrix))
+
+    #Every sample's populations come from the same CSV row, so its total is complete within any chunk
+    sample_totals = pd.DataFrame({'sample_id': matrix.samples['sample_id'], 'total_count': matrix.totals})
+
+    #A content hash per CSV row lets incremental loads tell new and changed samples from ones already loaded
+    sample_hashes = pd.DataFrame({
+        'sample_id': df['sample'],
+        'row_hash': row_hashes(df),
+    })
+
+    return {
+        'subjects': subjects,
+        'samples': samples,
+        'cell_counts': cell_counts,
+        'sample_totals': sample_totals,
+        'sample_hashes': sample_hashes,
+    }
+
+
+def to_records(table):
+    '''Convert a frame into a list of plain Python tuples (NaN becomes NULL).'''
+    table = table.astype(object).where(table.notna(), None)
+    return list(zip(*(table[col].tolist() for col in table.columns)))
+
+
+def set_load_pragmas(cur, bounded=False):
+    '''Trade durability for speed while the database is being rebuilt from the CSV.
+
+    With bounded=True the page cache is capped at stream_cache_kb and sorts (the stats_cube GROUP BY,
+    index builds) spill to temporary files, so memory stays flat however large the database gets.
+    '''
+    cur.execute("PRAGMA journal_mode = MEMORY")
+    cur.execute("PRAGMA synchronous = OFF")
+    if bounded:
+        cur.execute("PRAGMA temp_store = FILE")
+        cur.execute(f"PRAGMA cache_size = -{stream_cache_kb}")
+    else:
+        cur.execute("PRAGMA temp_store = MEMORY")
+        cur.execute("PRAGMA cache_size = -200000")
+
+
+def create_indexes(cur):
+    '''Build the secondary indexes and refresh the planner statistics, returning the elapsed seconds.'''
+    start = time.perf_counter()
+    for statement in indexes:
+        cur.execute(statement)
+    return time.perf_counter() - start
+
+
+def rebuild_cube(cur):
+    '''Recompute the stats_cube table from every loaded sample, returning the elapsed seconds.'''
+    start = time.perf_counter()
+    cur.execute("DELETE FROM stats_cube")
+    cur.execute(cube_delta_sql.format(sign=1, where="1"))
+    return time.perf_counter() - start
+
+
+def update_cube(cur, sign):
+    '''Add (sign=1) or remove (sign=-1) the samples in the temp table affected_samples from stats_cube.'''
+    start = time.perf_counter()
+    cur.execute(cube_delta_sql.format(sign=sign, where="cc.sample_id IN (SELECT sample_id FROM affected_samples)"))
+    cur.execute("DELETE FROM stats_cube WHERE n = 0")
+    return time.perf_counter() - start
+
+
+def add_timing(timings, name, rows, seconds):
+    '''Add rows and seconds to the (rows, seconds) running total of a load step.'''
+    total_rows, total_seconds = timings[name]
+    timings[name] = (total_rows + rows, total_seconds + seconds)
+
+
+def record_timings(timings):
+    '''Write every load step's (rows, seconds) to the instrumentation report.'''
+    for name, (rows, seconds) in timings.items():
+        instrumentation.record('span', f"load {name}", rows=rows, seconds=round(seconds, 6))
+
+
+def bulk_insert(cur, table, rows, sql=insert_sql):
+    '''Insert rows into a table through batched executemany calls, returning the elapsed seconds.'''
+    start = time.perf_counter()
+    for i in range(0, len(rows), batch_size):
+        cur.executemany(sql[table], rows[i:i + batch_size])
+    return time.perf_counter() - start
+
+
+def bulk_load(con, tables):
+    '''Load every table inside a single transaction and return per-table (rows, seconds).'''
+    cur = con.cursor()
+    set_load_pragmas(cur)
+    cur.executescript(schema)
+
+    #Inserting cell counts in primary key order keeps the (sample_id, population) index append-only
+    tables['cell_counts'] = tables['cell_counts'].sort_values(['sample_id', 'population'])
+
+    timings = {}
+    cur.execute("BEGIN")
+    for name, table in tables.items():
+        rows = to_records(table)
+        timings[name] = (len(rows), bulk_insert(cur, name, rows))
+    timings['stats_cube'] = (0, rebuild_cube(cur))
+    timings['indexes'] = (0, create_indexes(cur))
+    con.commit()
+    return timings
+
+
+def stream_load(con, csv_path, chunksize=chunk_size):
+    '''Read csv_path in fixed-size chunks and write each one to the database before reading the next.
+
+    Subjects repeat across chunks and are left to the primary key (INSERT OR IGNORE), like samples, so
+    no set of seen ids grows with the size of the export. The SQLite cache and sorts are bounded too (see
+    set_load_pragmas).
+    '''
+    cur = con.cursor()
+    set_load_pragmas(cur, bounded=True)
+    cur.executescript(schema)
+
+    timings = {name: (0, 0.0) for name in ['read'] + list(insert_sql)}
+    chunks = 0
+
+    start = time.perf_counter()
+    for chunk in pd.read_csv(csv_path, chunksize=chunksize):
+        add_timing(timings, 'read', len(chunk), time.perf_counter() - start)
+        chunks += 1
+
+        tables = split_tables(chunk)
+        tables['cell_counts'] = tables['cell_counts'].sort_values(['sample_id', 'population'])
+
+        cur.execute("BEGIN")
+        for name, table in tables.items():
+            rows = to_records(table)
+            add_timing(timings, name, len(rows), bulk_insert(cur, name, rows))
+        con.commit()
+        start = time.perf_counter()
+
+    timings['stats_cube'] = (0, rebuild_cube(cur))
+    timings['indexes'] = (0, create_indexes(cur))
+    con.commit()
+    print(f"Streamed {chunks} chunk(s) of up to {chunksize:,} rows")
+    return timings
+
+
+def incremental_load(con, csv_path, chunksize=None):
+    '''Upsert only the samples in csv_path that are new or whose row content changed since they were loaded.
+
+    Nothing is dropped: subjects, samples and cell counts already in the database are kept, and rows
+    whose content hash matches the one in sample_hashes are skipped without touching their tables.
+    stats_cube is updated by removing the old contribution of the affected samples and adding the new one.
+    '''
+    cur = con.cursor()
+    set_load_pragmas(cur)
+    had_totals = table_exists(con, 'sample_totals')
+    had_cube = table_exists(con, 'stats_cube')
+    cur.executescript(create_tables)
+    if not had_totals:
+        #Databases loaded before sample_totals existed get it backfilled once from cell_counts
+        cur.execute("INSERT INTO sample_totals (sample_id, total_count) SELECT sample_id, SUM(count) FROM cell_counts GROUP BY sample_id")
+        con.commit()
+    if not had_cube:
+        rebuild_cube(cur)
+        con.commit()
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS incoming_hashes (sample_id TEXT PRIMARY KEY, row_hash INTEGER)")
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS affected_samples (sample_id TEXT PRIMARY KEY)")
+
+    timings = {name: (0, 0.0) for name in ['read'] + list(insert_sql) + ['stats_cube']}
+    skipped = 0
+
+    start = time.perf_counter()
+    chunks = pd.read_csv(csv_path, chunksize=chunksize) if chunksize else [pd.read_csv(csv_path)]
+    for chunk in chunks:
+        add_timing(timings, 'read', len(chunk), time.perf_counter() - start)
+        tables = split_tables(chunk)
+
+        #Compare this chunk's row hashes against the ledger inside SQLite rather than pulling every stored hash into memory
+        cur.execute("BEGIN")
+        cur.execute("DELETE FROM incoming_hashes")
+        cur.executemany("INSERT OR REPLACE INTO incoming_hashes (sample_id, row_hash) VALUES (?, ?)", to_records(tables['sample_hashes']))
+        changed = {row[0] for row in cur.execute("""
+            SELECT i.sample_id
+            FROM incoming_hashes i
+            LEFT JOIN sample_hashes h ON i.sample_id = h.sample_id
+            WHERE h.row_hash IS NULL OR h.row_hash != i.row_hash
+            """)}
+        skipped += len(tables['sample_hashes']) - len(changed)
+
+        if changed:
+            #Totals are upserted with the counts, so sample_totals stays in step with cell_counts
+            for name in ['samples', 'cell_counts', 'sample_totals', 'sample_hashes']:
+                tables[name] = tables[name][tables[name]['sample_id'].isin(changed)]
+            tables['subjects'] = tables['subjects'][tables['subjects']['subject_id'].isin(tables['samples']['subject_id'])]
+            tables['cell_counts'] = tables['cell_counts'].sort_values(['sample_id', 'population'])
+
+            #The cube forgets the old version of every affected sample and then counts the new one; that is
+            #every changed sample plus every stored sample of their subjects, whose response may be upserted too
+            cur.execute("DELETE FROM affected_samples")
+            cur.executemany("INSERT OR IGNORE INTO affected_samples (sample_id) VALUES (?)", [(sample_id,) for sample_id in changed])
+            cur.executemany("INSERT OR IGNORE INTO affected_samples (sample_id) SELECT sample_id FROM samples WHERE subject_id = ?",
+                            [(subject_id,) for subject_id in tables['subjects']['subject_id']])
+            add_timing(timings, 'stats_cube', 0, update_cube(cur, -1))
+
+            for name, table in tables.items():
+                rows = to_records(table)
+                add_timing(timings, name, len(rows), bulk_insert(cur, name, rows, upsert_sql))
+            add_timing(timings, 'stats_cube', 0, update_cube(cur, 1))
+        con.commit()
+        start = time.perf_counter()
+
+    timings['indexes'] = (0, create_indexes(cur))
+    con.commit()
+    print(f"Skipped {skipped:,} sample(s) already loaded with identical content")
+    return timings
+
+
+def prepare_file(path):
+    '''Worker process entry point: parse and validate one CSV and turn it into insert-ready records.
+
+    Raises ValueError if the file is missing columns, repeats a sample, lacks ids, has invalid counts or
+    gives one subject two sets of metadata. Returns a dict with the file's fingerprint, row count, parse
+    seconds and {table name: list of row tuples}.
+    '''
+    start = time.perf_counter()
+    df = pd.read_csv(path)
+
+    missing = [col for col in csv_columns if col not in df.columns]
+    if missing:
+        raise ValueError(f"{path}: missing column(s) {', '.join(missing)}")
+    if df['sample'].isna().any() or df['subject'].isna().any():
+        raise ValueError(f"{path}: rows without a sample or subject id")
+    duplicated = df['sample'][df['sample'].duplicated()]
+    if len(duplicated):
+        raise ValueError(f"{path}: sample(s) listed more than once, e.g. {duplicated.iloc[0]}")
+    counts = df[cell_columns].apply(pd.to_numeric, errors='coerce')
+    if counts.isna().any().any() or (counts < 0).any().any() or (counts % 1 != 0).any().any():
+        raise ValueError(f"{path}: cell counts must be non-negative integers")
+
+    tables = split_tables(df)
+    inconsistent = tables['subjects']['subject_id'][tables['subjects']['subject_id'].duplicated()]
+    if len(inconsistent):
+        raise ValueError(f"{path}: subject {inconsistent.iloc[0]} has different metadata on different rows")
+    tables['cell_counts'] = tables['cell_counts'].sort_values(['sample_id', 'population'])
+
+    return {
+        'path': path,
+        'fingerprint': file_fingerprint(path),
+        'rows': len(df),
+        'seconds': time.perf_counter() - start,
+        'records': {name: to_records(table) for name, table in tables.items()},
+    }
+
+
+def sharded_load(con, paths, workers=None):
+    '''Rebuild the database from many CSVs: parse them in worker processes, write them from this one.
+
+    SQLite allows a single writer, so the workers only parse, validate and prepare records and this
+    process inserts each file as soon as it is ready. A subject must have the same metadata in every file
+    and a sample listed in two files must be identical; otherwise ValueError is raised and the whole load,
+    schema rebuild included, is rolled back. Returns per-table (rows, seconds) timings, where 'parse' is
+    the time spent waiting on the workers.
+    '''
+    cur = con.cursor()
+    set_load_pragmas(cur)
+    timings = {name: (0, 0.0) for name in ['parse'] + list(insert_sql)}
+    subjects, samples = {}, {}
+
+    #The schema is rebuilt inside the load's transaction, so a rejected load leaves the old database intact
+    cur.execute("BEGIN")
+    try:
+        for statement in schema.split(";"):
+            if statement.strip():
+                cur.execute(statement)
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pending = [pool.submit(prepare_file, path) for path in paths]
+            start = time.perf_counter()
+            for future in as_completed(pending):
+                shard = future.result()
+                add_timing(timings, 'parse', shard['rows'], time.perf_counter() - start)
+                records = shard['records']
+
+                #Subjects can span files (one file per project), samples should not
+                new_subjects = []
+                for row in records['subjects']:
+                    seen = subjects.setdefault(row[0], (row[1:], shard['path']))
+                    if seen[0] != row[1:]:
+                        raise ValueError(f"subject {row[0]} has different metadata in {seen[1]} and {shard['path']}")
+                    if seen[1] == shard['path']:
+                        new_subjects.append(row)
+                records['subjects'] = new_subjects
+                #Samples are compared on their insert-ready records (plain Python values, NULL for blanks), since
+                #the pandas row hash depends on the dtypes inferred for each file (e.g. an all-blank response column)
+                counts = {sample_id: tuple(row[1:] for row in rows) for sample_id, rows in groupby(records['cell_counts'], key=itemgetter(0))}
+                for row in records['samples']:
+                    content = hash((row[1:], counts.get(row[0], ())))
+                    seen = samples.setdefault(row[0], (content, shard['path']))
+                    if seen[0] != content:
+                        raise ValueError(f"sample {row[0]} differs between {seen[1]} and {shard['path']}")
+
+                for name, rows in records.items():
+                    add_timing(timings, name, len(rows), bulk_insert(cur, name, rows))
+                record_load(con, shard['fingerprint'], shard['path'], shard['rows'], commit=False)
+                start = time.perf_counter()
+
+        timings['stats_cube'] = (0, rebuild_cube(cur))
+        timings['indexes'] = (0, create_indexes(cur))
+        con.commit()
+    except BaseException:
+        con.rollback()
+        raise
+    print(f"Loaded {len(paths)} file(s) with up to {workers or os.cpu_count()} parser process(es)")
+    return timings
+
+
+def input_files(patterns):
+    '''Expand directories (every *.csv in them) and glob patterns into a sorted list of CSV paths.'''
+    paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            paths.update(glob.glob(os.path.join(pattern, "*.csv")))
+        else:
+            paths.update(glob.glob(pattern))
+    return sorted(paths)
+
+
+def file_fingerprint(path):
+    '''SHA-256 of the file contents, read in blocks so large exports aren't held in memory.'''
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def table_exists(con, name):
+    return con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone() is not None
+
+
+def already_loaded(con, fingerprint):
+    '''True when a file with this fingerprint has been recorded in the load ledger.'''
+    if not table_exists(con, 'load_ledger'):
+        return False
+    return con.execute("SELECT 1 FROM load_ledger WHERE fingerprint = ?", (fingerprint,)).fetchone() is not None
+
+
+def record_load(con, fingerprint, source, rows, commit=True):
+    '''Add the loaded file to the load ledger.'''
+    con.execute(
+        "INSERT OR REPLACE INTO load_ledger (fingerprint, source, rows, loaded_at) VALUES (?, ?, ?, datetime('now'))",
+        (fingerprint, source, rows))
+    if commit:
+        con.commit()
+
+
+def staging_path(db_path):
+    return db_path + ".staging"
+
+
+def remove_database(path):
+    '''Delete a database file together with its journal, WAL and shared-memory files.'''
+    for name in [path, path + "-journal", path + "-wal", path + "-shm"]:
+        if os.path.exists(name):
+            os.remove(name)
+
+
+def open_staging(db_path, copy=False):
+    '''Connect to a fresh staging database next to db_path; with copy=True it starts as a copy of db_path.
+
+    Loads write only to the staging database, so readers of db_path never see a half-built table.
+    '''
+    path = staging_path(db_path)
+    remove_database(path)
+    con = instrumentation.connect(path)
+    if copy and os.path.exists(db_path):
+        live = instrumentation.connect(db_path)
+        try:
+            live.backup(con)
+        finally:
+            live.close()
+    return con
+
+
+def publish(con, db_path):
+    '''Swap the finished staging database into db_path as one write transaction, returning the elapsed seconds.
+
+    db_path is kept in WAL mode, so readers are never blocked: queries already running finish on the old
+    data and later ones see the new data in full. The pages are copied with the backup API rather than by
+    renaming the file, because connections that are still open (e.g. the dashboard's pool) would keep
+    reading the replaced file and SQLite ties the -wal and -shm files to the path, not the file.
+    '''
+    start = time.perf_counter()
+    #Staging is written with an in-memory journal; in WAL mode its header matches the live database's
+    con.execute("PRAGMA journal_mode = WAL")
+    live = instrumentation.connect(db_path, timeout=60)
+    try:
+        live.execute("PRAGMA journal_mode = WAL")
+        con.backup(live)
+        #Fold the new pages back into the database file; readers still on the old data just make it partial
+        live.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        live.close()
+    return time.perf_counter() - start
+
+
+def peak_memory_mb():
+    '''Peak resident set size of this process in MB, or None where it can't be measured.'''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #ru_maxrss is reported in bytes on macOS and in kilobytes on Linux
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def legacy_load(con, tables):
+    '''Original row-at-a-time loader, kept as the baseline for the timing report.'''
+    cur = con.cursor()
+    cur.executescript(schema)
+
+    timings = {}
+    for name, table in tables.items():
+        start = time.perf_counter()
+        for _, row in table.iterrows():
+            cur.execute(insert_sql[name], tuple(None if pd.isna(v) else v for v in row))
+        timings[name] = (len(table), time.perf_counter() - start)
+    timings['stats_cube'] = (0, rebuild_cube(cur))
+    timings['indexes'] = (0, create_indexes(cur))
+    con.commit()
+    return timings
+
+
+def print_timings(label, timings):
+    print(f"{label} loader:")
+    for name, (rows, seconds) in timings.items():
+        rate = f"{rows / seconds:,.0f} rows/sec" if rows and seconds > 0 else ""
+        print(f"  {name:<12} {rows:>10,} rows  {seconds:8.3f} s  {rate}")
+    print(f"  {'total':<12} {'':>15}  {sum(s for _, s in timings.values()):8.3f} s")
+    peak = peak_memory_mb()
+    if peak is not None:
+        print(f"  peak memory  {peak:,.1f} MB")
+
+
+def load(csv_path=csv, db_path=database, loader=bulk_load, chunksize=None, incremental=False):
+    '''Load csv_path into the database at db_path and return the loader timings.
+
+    By default the database is rebuilt from scratch. When chunksize is given the CSV is streamed in
+    chunks of that many rows instead of being read whole. With incremental=True nothing is dropped and
+    only new or changed samples are written; None is returned if the file was already loaded.
+    Every load is built in a staging database and published to db_path in one step when it is complete.
+    '''
+    fingerprint = file_fingerprint(csv_path)
+    if incremental:
+        con = instrumentation.connect(db_path)
+        try:
+            if already_loaded(con, fingerprint):
+                return None
+        finally:
+            con.close()
+
+    #Connect to the staging database; incremental loads start from a copy of the live one
+    con = open_staging(db_path, copy=incremental)
+    try:
+        if incremental:
+            timings = incremental_load(con, csv_path, chunksize)
+        elif chunksize:
+            timings = stream_load(con, csv_path, chunksize)
+        else:
+            #Load cell_count.csv into a Data Frame
+            with instrumentation.span("read_csv") as span:
+                df = pd.read_csv(csv_path)
+                span['rows'] = len(df)
+
+            #Split csv data into tables
+            with instrumentation.span("split_tables"):
+                tables = split_tables(df, report=True)
+            timings = loader(con, tables)
+        record_load(con, fingerprint, csv_path, timings['samples'][0])
+        timings['publish'] = (0, publish(con, db_path))
+    except ValueError as e:
+        #Invalid counts are only found while splitting; the staging database is discarded and the live one is untouched
+        raise ValueError(f"{csv_path}: {e}") from e
+    finally:
+        con.close()
+        remove_database(staging_path(db_path))
+    record_timings(timings)
+    return timings
+
+
+def ingest(paths, db_path=database, workers=None):
+    '''Rebuild the database at db_path from several CSVs parsed in parallel, returning the loader timings.'''
+    con = open_staging(db_path)
+    try:
+        timings = sharded_load(con, paths, workers)
+        timings['publish'] = (0, publish(con, db_path))
+    finally:
+        con.close()
+        remove_database(staging_path(db_path))
+    record_timings(timings)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load cell-count.csv into the loblawbio SQLite database.")
+    parser.add_argument("--csv", default=csv, help="input CSV file")
+    parser.add_argument("--db", default=database, help="SQLite database to (re)build")
+    parser.add_argument("--legacy", action="store_true", help="use the original row-at-a-time loader")
+    parser.add_argument("--compare", action="store_true", help="also time the legacy loader against a scratch database")
+    parser.add_argument("--stream", action="store_true", help="read the CSV in chunks so memory stays flat")
+    parser.add_argument("--chunksize", type=int, default=chunk_size, help="rows per chunk in streaming mode")
+    parser.add_argument("--incremental", action="store_true", help="keep existing data and only upsert new or changed samples")
+    parser.add_argument("--inputs", nargs="+", help="load every CSV in these directories or glob patterns instead of --csv, parsed in parallel")
+    parser.add_argument("--workers", type=int, default=None, help="parser processes for --inputs (default: all cores)")
+    args = parser.parse_args()
+    instrumentation.start("load_data")
+
+    #A rejected load (invalid counts, conflicting files) only ever wrote to the staging database
+    try:
+        if args.inputs:
+            paths = input_files(args.inputs)
+            if not paths:
+                parser.error(f"no CSV files match {' '.join(args.inputs)}")
+            timings = ingest(paths, args.db, args.workers)
+            print_timings("Sharded", timings)
+        elif args.incremental:
+            timings = load(args.csv, args.db, chunksize=args.chunksize if args.stream else None, incremental=True)
+            if timings is None:
+                print(f"{args.csv} is unchanged since it was last loaded, skipping.")
+                return
+            print_timings("Incremental", timings)
+        elif args.stream:
+            timings = load(args.csv, args.db, chunksize=args.chunksize)
+            print_timings("Streaming", timings)
+        else:
+            timings = load(args.csv, args.db, legacy_load if args.legacy else bulk_load)
+            print_timings("Legacy" if args.legacy else "Bulk", timings)
+    except ValueError as e:
+        sys.exit(f"Load rejected, the database was left unchanged: {e}")
 
-# Samples
-for _, row in samples.iterrows():
-    cur.execute("INSERT OR IGNORE INTO samples (sample_id, subject_id, project, sample_type, time_from_treatment_start) VALUES (?, ?, ?, ?, ?)", tuple(row))
+    if args.compare:
+        with tempfile.TemporaryDirectory() as tmp:
+            other = legacy_load if not args.legacy else bulk_load
+            other_timings = load(args.csv, os.path.join(tmp, "compare.db"), other)
+        print_timings("Bulk" if args.legacy else "Legacy", other_timings)
 
-# Cell Counts
-for _, row in cell_counts.iterrows():
-    cur.execute("INSERT OR IGNORE INTO cell_counts (sample_id, population, count) VALUES (?, ?, ?)", tuple(row))
+    #Print confirmation
+    print("Data loaded successfully into the database.")
 
-con.commit()
-con.close()
 
-#Print confirmation
-print("Data loaded successfully into the database.")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+'''Pipeline: run the four parts as a dependency graph, skipping stages whose inputs are unchanged'''
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from load_data import file_fingerprint
+
+#Fingerprint and timings of the last successful run of every stage
+state_file = "Outputs/pipeline_state.json"
+
+#name -> command, stages it runs after, files it reads (scripts and modules included), files it writes (globs allowed)
+stages = {
+    'load': {
+        'command': ["load_data.py"],
+        'after': [],
+        'inputs': ["cell-count.csv", "load_data.py", "data_model.py", "instrumentation.py"],
+        'outputs': ["Outputs/loblawbio.db"],
+    },
+    'summary': {
+        'command': ["summary.py"],
+        'after': ['load'],
+        'inputs': ["Outputs/loblawbio.db", "summary.py", "queries.py", "exports.py", "instrumentation.py"],
+        'outputs': ["Outputs/relative_frequencies.csv"],
+    },
+    'stat_analysis': {
+        'command': ["stat_analysis.py", "--headless"],
+        'after': ['load'],
+        'inputs': ["Outputs/loblawbio.db", "stat_analysis.py", "stat_tests.py", "queries.py", "exports.py", "data_model.py", "instrumentation.py"],
+        'outputs': ["Outputs/cell_pops_miraclib.csv", "Outputs/population_stats.csv", "Outputs/stats_boxplot.png",
+                    "Outputs/cp_time*.csv", "Outputs/stats_time*.csv", "Outputs/stats_boxplot_time*.png",
+                    "Outputs/boxplot_summary.csv", "Outputs/boxplot_outliers.csv",
+                    "Outputs/trajectory_changes.csv", "Outputs/stats_change_time*.csv"],
+    },
+    'subset_analysis': {
+        'command': ["subset_analysis.py"],
+        'after': ['load'],
+        'inputs': ["Outputs/loblawbio.db", "subset_analysis.py", "queries.py", "exports.py", "instrumentation.py"],
+        'outputs': ["Outputs/mel_PBMC_samples_t0.csv", "Outputs/project_sample_nums.csv",
+                    "Outputs/response_subject_nums.csv", "Outputs/sex_subject_nums.csv"],
+    },
+}
+
+
+def stage_fingerprint(stage):
+    '''SHA-256 over the stage's command and the contents of all of its inputs.'''
+    digest = hashlib.sha256(json.dumps(stage['command']).encode())
+    for path in stage['inputs']:
+        digest.update(path.encode())
+        digest.update(file_fingerprint(path).encode())
+    return digest.hexdigest()
+
+
+def outputs_exist(stage):
+    return all(glob.glob(pattern) for pattern in stage['outputs'])
+
+
+def run_stage(name, command):
+    '''Run one stage's script in its own interpreter and return (name, exit code, captured output, seconds).'''
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable] + command, capture_output=True, text=True)
+    return name, result.returncode, result.stdout + result.stderr, time.perf_counter() - start
+
+
+def run(force=False, workers=None, verbose=False, parquet=False):
+    '''Run every stage once its upstream stages are done, concurrently where the graph allows.
+
+    A stage is skipped when its fingerprint matches the last successful run and its outputs exist.
+    Fingerprints are taken just before a stage starts, so a stage downstream of one that rewrote its
+    outputs always sees the new files. With parquet=True the analysis scripts also write Parquet copies
+    of their tables, which changes their commands and so reruns them once. Returns {stage: (status, seconds)}.
+    '''
+    #This run's copy of the stages, so the options don't leak into the module-level graph or later runs
+    plan = {name: dict(stage) for name, stage in stages.items()}
+    if parquet:
+        for name in ['summary', 'stat_analysis', 'subset_analysis']:
+            plan[name]['command'] = plan[name]['command'] + ["--parquet"]
+
+    state = {}
+    if os.path.exists(state_file):
+        with open(state_file) as f:
+            state = json.load(f)
+
+    report = {}
+    done, failed, running = set(), set(), {}
+    with ThreadPoolExecutor(max_workers=workers or len(plan)) as pool:
+        while len(done) + len(failed) < len(plan):
+            for name, stage in plan.items():
+                if name in done or name in failed or name in running.values():
+                    continue
+                if any(dep in failed for dep in stage['after']):
+                    failed.add(name)
+                    report[name] = ("not run", 0.0)
+                    continue
+                if not all(dep in done for dep in stage['after']):
+                    continue
+                fingerprint = stage_fingerprint(stage)
+                if not force and state.get(name, {}).get('fingerprint') == fingerprint and outputs_exist(stage):
+                    done.add(name)
+                    report[name] = ("skipped", 0.0)
+                    print(f"{name}: inputs unchanged, skipping.")
+                    continue
+                print(f"{name}: running {' '.join(stage['command'])}")
+                running[pool.submit(run_stage, name, stage['command'])] = name
+
+            if not running:
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                del running[future]
+                name, code, output, elapsed = future.result()
+                if verbose or code != 0:
+                    print(output)
+                if code == 0:
+                    done.add(name)
+                    report[name] = ("ran", elapsed)
+                    #Recorded against the inputs as they are now, i.e. after the stage has run
+                    state[name] = {'fingerprint': stage_fingerprint(plan[name]), 'seconds': round(elapsed, 3)}
+                else:
+                    failed.add(name)
+                    report[name] = (f"failed ({code})", elapsed)
+                print(f"{name}: {report[name][0]} in {elapsed:.2f} s")
+
+    with open(state_file, "w") as f:
+        json.dump(state, f, indent=2)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run load_data, summary, stat_analysis and subset_analysis as a cached dependency graph.")
+    parser.add_argument("--force", action="store_true", help="rerun every stage even if its inputs are unchanged")
+    parser.add_argument("--workers", type=int, default=None, help="stages run at once after the load (default: all of them)")
+    parser.add_argument("--parquet", action="store_true", help="also write typed Parquet copies of the output tables (needs pyarrow)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="print each stage's output")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    report = run(args.force, args.workers, args.verbose, args.parquet)
+    print()
+    print(f"  {'stage':<18}{'status':<14}{'seconds':>9}")
+    for name, (status, elapsed) in report.items():
+        print(f"  {name:<18}{status:<14}{elapsed:>9.2f}")
+    print(f"Pipeline finished in {time.perf_counter() - start:.2f} s")
+    sys.exit(1 if any(status not in ("ran", "skipped") for status, _ in report.values()) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+'''SQL queries used by the analysis scripts, kept in one place so their query plans can be checked'''
+
+#Part 3: sufficient statistics of the percentages per condition, treatment, sample type, timepoint, response and population
+stats_cube = """
+    SELECT condition, treatment, sample_type, time_from_treatment_start, response, population, n, sum_percentage, sumsq_percentage
+    FROM stats_cube;
+    """
+
+#Part 3: cell counts at every timepoint for one condition, treatment and sample type (parameters)
+cohort = """
+    SELECT su.subject_id, su.condition, su.treatment, su.response, sa.sample_id, sa.sample_type, sa.time_from_treatment_start, cc.population, cc.count
+    FROM subjects su
+    JOIN samples sa ON su.subject_id = sa.subject_id
+    JOIN cell_counts cc ON sa.sample_id = cc.sample_id
+    WHERE su.condition = ? AND su.treatment = ? AND sa.sample_type = ?;
+    """
+
+#Part 4: samples and subject details for one condition, treatment, sample type and timepoint (parameters)
+subset = """
+    SELECT sa.sample_id, sa.project, su.subject_id, su.response, su.sex, su.age
+    FROM subjects su
+    JOIN samples sa ON su.subject_id = sa.subject_id
+    WHERE su.condition = ? AND su.treatment = ? AND sa.sample_type = ? AND sa.time_from_treatment_start = ?
+    ORDER BY sa.sample_id;
+    """
+
+#Dashboard: filter options and relative frequencies filtered on sample and/or population
+sample_ids = """
+    SELECT sample_id
+    FROM samples
+    ORDER BY sample_id;
+    """
+
+populations = """
+    SELECT DISTINCT population
+    FROM cell_counts
+    ORDER BY population;
+    """
+
+
+def _relative_frequency_filters(n_samples, n_populations, keyset=False):
+    filters = []
+    if n_samples:
+        filters.append(f"cc.sample_id IN ({', '.join('?' * n_samples)})")
+    if n_populations:
+        filters.append(f"cc.population IN ({', '.join('?' * n_populations)})")
+    if keyset:
+        filters.append("(cc.sample_id, cc.population) > (?, ?)")
+    return f"WHERE {' AND '.join(filters)}" if filters else ""
+
+
+def filtered_relative_frequencies(n_samples=0, n_populations=0, keyset=False, limit=False):
+    '''Relative frequencies in (sample_id, population) order, filtered on sample and/or population.
+
+    Parameters are one per sample id, then one per population (0 = no filter), then with keyset=True the
+    (sample_id, population) to start after, then with limit=True the page size.
+    '''
+    return f"""
+    SELECT cc.sample_id, totals.total_count, cc.population, cc.count, CAST(100.0 * cc.count AS FLOAT) / totals.total_count AS percentage
+    FROM cell_counts cc
+    JOIN sample_totals totals ON cc.sample_id = totals.sample_id
+    {_relative_frequency_filters(n_samples, n_populations, keyset)}
+    ORDER BY cc.sample_id, cc.population
+    {"LIMIT ?" if limit else ""};
+    """
+
+
+#Part 2: every sample's relative frequencies, streamed straight from the cursor to relative_frequencies.csv
+relative_frequencies = filtered_relative_frequencies()
+
+
+def count_relative_frequencies(n_samples=0, n_populations=0):
+    '''Number of rows filtered_relative_frequencies returns for the same filters.'''
+    return f"""
+    SELECT COUNT(*) AS row_count
+    FROM cell_counts cc
+    {_relative_frequency_filters(n_samples, n_populations)};
+    """
+
+
+#Every query the project runs, with example parameters, for check_query_plans.py
+catalog = {
+    'relative_frequencies': (relative_frequencies, ()),
+    'cohort': (cohort, ('melanoma', 'miraclib', 'PBMC')),
+    'stats_cube': (stats_cube, ()),
+    'subset': (subset, ('melanoma', 'miraclib', 'PBMC', 0)),
+    'sample_ids': (sample_ids, ()),
+    'populations': (populations, ()),
+    'filtered_relative_frequencies': (filtered_relative_frequencies(2, 1), ('sample00000', 'sample00001', 'b_cell')),
+    'count_relative_frequencies': (count_relative_frequencies(1, 0), ('sample00000',)),
+    'relative_frequencies_page': (filtered_relative_frequencies(keyset=True, limit=True), ('sample00000', 'b_cell', 100)),
+    'population_relative_frequencies_page': (filtered_relative_frequencies(0, 1, keyset=True, limit=True), ('b_cell', 'sample00000', 'b_cell', 100)),
+    'populations_relative_frequencies_page': (filtered_relative_frequencies(0, 2, keyset=True, limit=True), ('b_cell', 'nk_cell', 'sample00000', 'b_cell', 100)),
+    'count_population_relative_frequencies': (count_relative_frequencies(0, 1), ('b_cell',)),
+}
+
+#Paged queries must come out of an index in ORDER BY order; sorting every remaining match per page is a regression
+index_ordered = {'relative_frequencies_page', 'population_relative_frequencies_page', 'populations_relative_frequencies_page'}
+
+#Tables a query is expected to read in full; a full scan of anything else is a regression
+#relative_frequencies reads every cell count by design, stats_cube is a few hundred rows of aggregates
+#sample_ids lists every sample and populations is only run once per database change (the dashboard caches it)
+allowed_scans = {
+    'relative_frequencies': {'cell_counts'},
+    'stats_cube': {'stats_cube'},
+    'sample_ids': {'samples'},
+    'populations': {'cell_counts'},
+}
@@ -1,263 +1,335 @@
 '''Part 3: Statistical Analysis'''
 
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 import pandas as pd
-import sqlite3
+import matplotlib.cbook as cbook
 import matplotlib.pyplot as plt
 import seaborn as sns
-from scipy.stats import ttest_ind
-
-'''Compare Population Relative Frequencies in Immune Responses from Responders and Non-responders'''
-#Connect to the SQLite database
-con = sqlite3.connect("Outputs/loblawbio.db")
-
-#Run SQL query to get cell population relative frequency data for melanoma patients receiving miraclib
-#Exclude samples taken at time 0 (see following analysis for time 0 that shows no significant differences in initial populations between responders and nonresponders)
-cell_pops_miraclib = pd.read_sql_query("""
-    SELECT su.subject_id, su.condition, su.treatment, su.response, sa.sample_id, sa.sample_type, totals.total_count, cc.population, cc.count, CAST(100.0 * cc.count AS FLOAT) / totals.total_count AS percentage
-    FROM subjects su
-    JOIN samples sa ON su.subject_id = sa.subject_id
-    JOIN cell_counts cc ON sa.sample_id = cc.sample_id
-    JOIN (
-        SELECT sample_id, SUM(count) AS total_count
-        FROM cell_counts
-        GROUP BY sample_id
-    ) AS totals ON cc.sample_id = totals.sample_id
-    WHERE su.condition = 'melanoma' AND su.treatment = 'miraclib' AND sa.sample_type = 'PBMC' AND sa.time_from_treatment_start > 0;
-    """, con)
-
-# print(cell_pops_miraclib)
-cell_pops_miraclib.to_csv("Outputs/cell_pops_miraclib.csv", index=False)
-
-con.close()
-
-#T-test to compare the relative frequencies of populations between responders and non-responders
-#Null hypothesis = no difference in relative frequencies between responders and non-responders
-#Alternative hypothesis = there's a difference in relative frequencies between responders and non-responders
-stats = []
-
-for pop in cell_pops_miraclib['population'].unique():
-    responder_vals = cell_pops_miraclib[(cell_pops_miraclib['population'] == pop) & (cell_pops_miraclib['response'] == 'yes')]['percentage']
-    non_responder_vals = cell_pops_miraclib[(cell_pops_miraclib['population'] == pop) & (cell_pops_miraclib['response'] == 'no')]['percentage']
-    if len(responder_vals) > 0 and len(non_responder_vals) > 0:
-        t_stat, p_value = ttest_ind(responder_vals, non_responder_vals, equal_var=False)
-        stats.append({
-            'population': pop,
-            'responder_mean': responder_vals.mean(),
-            'non_responder_mean': non_responder_vals.mean(),
-            't_statistic': t_stat,
-            'p_value': p_value
-        })
-
-#Convert stats to DataFrame
-stats_df = pd.DataFrame(stats)
-print("T-Test Results:")
-print(stats_df)
-print()
-print("Analysis suggests that B-cells and CD4 T-cells have a significant difference in relative frequency between responders and non-responders. Respectively, p=0.011 < p=0.05 and p=0.002 < 0.05 (given a significance level of 0.05). There is no significant difference between the other cell population relative frequencies.")
-print()
-
-#Save stats to CSV
-stats_df.to_csv("Outputs/population_stats.csv", index=False)
-
-#Boxplot
-plt.figure(figsize=(12, 6))
-sns.boxplot(x='population', y='percentage', hue='response', data=cell_pops_miraclib)
-for i, row in stats_df.iterrows():
-    p = row['p_value']
-    label = f"p = {p:.3g}"
-    y_max = cell_pops_miraclib[cell_pops_miraclib['population'] == row['population']]['percentage'].max()
-    plt.text(i, y_max + 1, label, ha='center', fontsize=10)
-plt.title('Comparison of Relative Frequencies of Immune Cell Populations in Miraclib Responders vs. Non-Responders')
-plt.xlabel('Cell Population')
-plt.ylabel('Relative Frequency (%)')
-plt.legend(title='Response', loc='upper right')
-plt.tight_layout()
-plt.savefig("Outputs/stats_boxplot.png")
-plt.show()
-
-'''Compare Population Relative Frequencies at Each Time Point from Treatment Start'''
-#Day 0 Analysis
-con = sqlite3.connect("Outputs/loblawbio.db")
-
-cp_time0 = pd.read_sql_query("""
-    SELECT su.subject_id, su.condition, su.treatment, su.response, sa.sample_id, sa.sample_type, sa.time_from_treatment_start, totals.total_count, cc.population, cc.count, CAST(100.0 * cc.count AS FLOAT) / totals.total_count AS percentage
-    FROM subjects su
-    JOIN samples sa ON su.subject_id = sa.subject_id
-    JOIN cell_counts cc ON sa.sample_id = cc.sample_id
-    JOIN (
-        SELECT sample_id, SUM(count) AS total_count
-        FROM cell_counts
-        GROUP BY sample_id
-    ) AS totals ON cc.sample_id = totals.sample_id
-    WHERE su.condition = 'melanoma' AND su.treatment = 'miraclib' AND sa.sample_type = 'PBMC' AND sa.time_from_treatment_start = 0;
-    """, con)
-
-# print(cp_time0)
-cp_time0.to_csv("Outputs/cp_time0.csv", index=False)
-
-con.close()
-
-#T-tests
-stats = []
-
-for pop in cp_time0['population'].unique():
-    responder_vals = cp_time0[(cp_time0['population'] == pop) & (cp_time0['response'] == 'yes')]['percentage']
-    non_responder_vals = cp_time0[(cp_time0['population'] == pop) & (cp_time0['response'] == 'no')]['percentage']
-    if len(responder_vals) > 0 and len(non_responder_vals) > 0:
-        t_stat, p_value = ttest_ind(responder_vals, non_responder_vals, equal_var=False)
-        stats.append({
-            'population': pop,
-            'responder_mean': responder_vals.mean(),
-            'non_responder_mean': non_responder_vals.mean(),
-            't_statistic': t_stat,
-            'p_value': p_value
-        })
-
-stats_df = pd.DataFrame(stats)
-print("T-Test Results when Time from Treatment = 0:")
-print(stats_df)
-print()
-print("Given a significance level of 0.05, analysis suggests that there is no significant difference in relative frequencies between responders and non-responders when time from treatment = 0.")
-print()
-
-stats_df.to_csv("Outputs/stats_time0.csv", index=False)
-
-#Boxplot
-plt.figure(figsize=(12, 6))
-sns.boxplot(x='population', y='percentage', hue='response', data=cp_time0)
-for i, row in stats_df.iterrows():
-    p = row['p_value']
-    label = f"p = {p:.3g}"
-    y_max = cp_time0[cp_time0['population'] == row['population']]['percentage'].max()
-    plt.text(i, y_max + 1, label, ha='center', fontsize=10)
-plt.title(f'Frequencies of Immune Cell Populations in Miraclib Responders vs. Non-Responders when Time From Treatment = 0')
-plt.xlabel('Cell Population')
-plt.ylabel('Relative Frequency (%)')
-plt.legend(title='Response', loc='upper right')
-plt.tight_layout()
-plt.savefig("Outputs/stats_boxplot_time0.png")
-plt.show()
-
-#Day 7 Analysis
-con = sqlite3.connect("Outputs/loblawbio.db")
-
-cp_time7 = pd.read_sql_query("""
-    SELECT su.subject_id, su.condition, su.treatment, su.response, sa.sample_id, sa.sample_type, sa.time_from_treatment_start, totals.total_count, cc.population, cc.count, CAST(100.0 * cc.count AS FLOAT) / totals.total_count AS percentage
-    FROM subjects su
-    JOIN samples sa ON su.subject_id = sa.subject_id
-    JOIN cell_counts cc ON sa.sample_id = cc.sample_id
-    JOIN (
-        SELECT sample_id, SUM(count) AS total_count
-        FROM cell_counts
-        GROUP BY sample_id
-    ) AS totals ON cc.sample_id = totals.sample_id
-    WHERE su.condition = 'melanoma' AND su.treatment = 'miraclib' AND sa.sample_type = 'PBMC' AND sa.time_from_treatment_start = 7;
-    """, con)
-
-# print(cp_time7)
-cp_time7.to_csv("Outputs/cp_time7.csv", index=False)
-
-con.close()
-
-#T-tests
-stats = []
-
-for pop in cp_time7['population'].unique():
-    responder_vals = cp_time7[(cp_time7['population'] == pop) & (cp_time7['response'] == 'yes')]['percentage']
-    non_responder_vals = cp_time7[(cp_time7['population'] == pop) & (cp_time7['response'] == 'no')]['percentage']
-    if len(responder_vals) > 0 and len(non_responder_vals) > 0:
-        t_stat, p_value = ttest_ind(responder_vals, non_responder_vals, equal_var=False)
-        stats.append({
-            'population': pop,
-            'responder_mean': responder_vals.mean(),
-            'non_responder_mean': non_responder_vals.mean(),
-            't_statistic': t_stat,
-            'p_value': p_value
-        })
-
-stats_df = pd.DataFrame(stats)
-print("T-Test Results when Time from Treatment = 7:")
-print(stats_df)
-print()
-print("Analysis suggests that CD4 T-cells have a statistically significant difference in relative frequencies between responders and non-responders when time from treatment = 7. p=0.01 < 0.05 (given a significance level of 0.05). There is no significant difference between the other cell population relative frequencies.")
-print()
-
-stats_df.to_csv("Outputs/stats_time7.csv", index=False)
-
-#Boxplot
-plt.figure(figsize=(12, 6))
-sns.boxplot(x='population', y='percentage', hue='response', data=cp_time7)
-for i, row in stats_df.iterrows():
-    p = row['p_value']
-    label = f"p = {p:.3g}"
-    y_max = cp_time7[cp_time7['population'] == row['population']]['percentage'].max()
-    plt.text(i, y_max + 1, label, ha='center', fontsize=10)
-plt.title(f'Frequencies of Immune Cell Populations in Miraclib Responders vs. Non-Responders when Time From Treatment = 7')
-plt.xlabel('Cell Population')
-plt.ylabel('Relative Frequency (%)')
-plt.legend(title='Response', loc='upper right')
-plt.tight_layout()
-plt.savefig("Outputs/stats_boxplot_time7.png")
-plt.show()
-
-#Day 14 Analysis
-con = sqlite3.connect("Outputs/loblawbio.db")
-
-cp_time14 = pd.read_sql_query("""
-    SELECT su.subject_id, su.condition, su.treatment, su.response, sa.sample_id, sa.sample_type, sa.time_from_treatment_start, totals.total_count, cc.population, cc.count, CAST(100.0 * cc.count AS FLOAT) / totals.total_count AS percentage
-    FROM subjects su
-    JOIN samples sa ON su.subject_id = sa.subject_id
-    JOIN cell_counts cc ON sa.sample_id = cc.sample_id
-    JOIN (
-        SELECT sample_id, SUM(count) AS total_count
-        FROM cell_counts
-        GROUP BY sample_id
-    ) AS totals ON cc.sample_id = totals.sample_id
-    WHERE su.condition = 'melanoma' AND su.treatment = 'miraclib' AND sa.sample_type = 'PBMC' AND sa.time_from_treatment_start = 14;
-    """, con)
-
-# print(cp_time14)
-cp_time14.to_csv("Outputs/cp_time14.csv", index=False)
-
-con.close()
-
-#T-tests
-stats = []
-
-for pop in cp_time14['population'].unique():
-    responder_vals = cp_time14[(cp_time14['population'] == pop) & (cp_time14['response'] == 'yes')]['percentage']
-    non_responder_vals = cp_time14[(cp_time14['population'] == pop) & (cp_time14['response'] == 'no')]['percentage']
-    if len(responder_vals) > 0 and len(non_responder_vals) > 0:
-        t_stat, p_value = ttest_ind(responder_vals, non_responder_vals, equal_var=False)
-        stats.append({
-            'population': pop,
-            'responder_mean': responder_vals.mean(),
-            'non_responder_mean': non_responder_vals.mean(),
-            't_statistic': t_stat,
-            'p_value': p_value
-        })
-
-stats_df = pd.DataFrame(stats)
-print("T-Test Results when Time from Treatment = 14:")
-print(stats_df)
-print()
-print("Analysis suggests that B-cells have a statistically significant difference in relative frequencies between responders and non-responders when time from treatment = 14. p=0.03 < 0.05 (given a significance level of 0.05). There is no significant differnce between the other cell population relative frequencies.")
-print()
-
-stats_df.to_csv("Outputs/stats_time14.csv", index=False)
-
-#Boxplot
-plt.figure(figsize=(12, 6))
-sns.boxplot(x='population', y='percentage', hue='response', data=cp_time14)
-for i, row in stats_df.iterrows():
-    p = row['p_value']
-    label = f"p = {p:.3g}"
-    y_max = cp_time14[cp_time14['population'] == row['population']]['percentage'].max()
-    plt.text(i, y_max + 1, label, ha='center', fontsize=10)
-plt.title(f'Frequencies of Immune Cell Populations in Miraclib Responders vs. Non-Responders when Time From Treatment = 14')
-plt.xlabel('Cell Population')
-plt.ylabel('Relative Frequency (%)')
-plt.legend(title='Response', loc='upper right')
-plt.tight_layout()
-plt.savefig("Outputs/stats_boxplot_time14.png")
-plt.show()
\ No newline at end of file
+
+import instrumentation
+import queries
+from data_model import CellMatrix, memory_report
+from exports import chunk_rows, pyarrow, write_frames, write_table
+from stat_tests import change_tests, group_moments, pool_moments, resampling_tests, welch_ttests
+
+database = "Outputs/loblawbio.db"
+
+#Data hash each boxplot PNG was last rendered from, so unchanged figures are skipped in headless mode
+plot_hashes = "Outputs/plot_hashes.json"
+
+#Interpretation printed under each set of t-test results (keyed by timepoint, None = timepoints > 0 pooled)
+blurbs = {
+    None: "Analysis suggests that B-cells and CD4 T-cells have a significant difference in relative frequency between responders and non-responders. Respectively, p=0.011 < p=0.05 and p=0.002 < 0.05 (given a significance level of 0.05). There is no significant difference between the other cell population relative frequencies.",
+    0: "Given a significance level of 0.05, analysis suggests that there is no significant difference in relative frequencies between responders and non-responders when time from treatment = 0.",
+    7: "Analysis suggests that CD4 T-cells have a statistically significant difference in relative frequencies between responders and non-responders when time from treatment = 7. p=0.01 < 0.05 (given a significance level of 0.05). There is no significant difference between the other cell population relative frequencies.",
+    14: "Analysis suggests that B-cells have a statistically significant difference in relative frequencies between responders and non-responders when time from treatment = 14. p=0.03 < 0.05 (given a significance level of 0.05). There is no significant differnce between the other cell population relative frequencies.",
+}
+
+
+def load_cohort_matrix(db_path=database, condition='melanoma', treatment='miraclib', sample_type='PBMC'):
+    '''Pull the cell counts of every timepoint for one cohort in a single query, as a count matrix.'''
+    con = instrumentation.connect(db_path)
+    try:
+        with instrumentation.span("query cohort") as span:
+            counts = pd.read_sql_query(queries.cohort, con, params=(condition, treatment, sample_type))
+            span['rows'] = len(counts)
+    finally:
+        con.close()
+    #The count matrix sorts samples and populations, so the planner is free to drive the query from the cohort indexes
+    with instrumentation.span("count matrix", rows=len(counts)):
+        matrix = CellMatrix.from_long(counts)
+    print(memory_report("Cohort", counts, matrix))
+    print()
+    return matrix
+
+
+def stratum_stats(cohort):
+    '''Welch's t-tests of responder vs. non-responder percentages for every population in every stratum.
+
+    The strata are each timepoint plus 'pooled' (all timepoints > 0). Moments are computed with one
+    groupby over (timepoint, population, response), pooled from those moments, and every stratum x
+    population test is evaluated in a single vectorized call.
+    '''
+    #Null hypothesis = no difference in relative frequencies between responders and non-responders
+    #Alternative hypothesis = there's a difference in relative frequencies between responders and non-responders
+    moments = group_moments(cohort, ['time_from_treatment_start', 'population', 'response'])
+    pooled = pool_moments(moments[moments['time_from_treatment_start'] > 0], ['population', 'response'])
+
+    moments['stratum'] = moments.pop('time_from_treatment_start').astype(str)
+    pooled['stratum'] = 'pooled'
+    return welch_ttests(pd.concat([moments, pooled], ignore_index=True), ['stratum', 'population'])
+
+
+def boxplot(data, stats_df, title, path, show=True):
+    '''Boxplot of percentages by population and response, annotated with each population's p-value.'''
+    plt.figure(figsize=(12, 6))
+    sns.boxplot(x='population', y='percentage', hue='response', data=data)
+    for i, row in stats_df.iterrows():
+        p = row['p_value']
+        label = f"p = {p:.3g}"
+        y_max = data[data['population'] == row['population']]['percentage'].max()
+        plt.text(i, y_max + 1, label, ha='center', fontsize=10)
+    plt.title(title)
+    plt.xlabel('Cell Population')
+    plt.ylabel('Relative Frequency (%)')
+    plt.legend(title='Response', loc='upper right')
+    plt.tight_layout()
+    plt.savefig(path)
+    if show:
+        plt.show()
+    plt.close()
+
+
+def render_boxplot(job):
+    '''Worker process entry point: draw one boxplot PNG from its exported CSVs with a non-interactive backend.'''
+    data_path, stats_path, title, plot_path = job
+    plt.switch_backend('Agg')
+    boxplot(pd.read_csv(data_path), pd.read_csv(stats_path), title, plot_path, show=False)
+    return plot_path
+
+
+def file_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def render_boxplots(jobs, workers=None):
+    '''Render boxplot PNGs concurrently, skipping any whose data, stats and title are unchanged since the last render.'''
+    cache = {}
+    if os.path.exists(plot_hashes):
+        with open(plot_hashes) as f:
+            cache = json.load(f)
+
+    todo = []
+    for data_path, stats_path, title, plot_path in jobs:
+        key = hashlib.sha256((file_hash(data_path) + file_hash(stats_path) + title).encode()).hexdigest()
+        if cache.get(plot_path) == key and os.path.exists(plot_path):
+            print(f"{plot_path} is up to date, skipping.")
+            continue
+        todo.append(((data_path, stats_path, title, plot_path), key))
+
+    if todo:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for plot_path in pool.map(render_boxplot, [job for job, _ in todo]):
+                print(f"Rendered {plot_path}")
+        cache.update({job[3]: key for job, key in todo})
+        with open(plot_hashes, "w") as f:
+            json.dump(cache, f, indent=2)
+
+
+def analyze(matrix, stats, timepoint=None, plot_jobs=None, parquet=False):
+    '''Export the data, t-test results and boxplot for one timepoint (None = all timepoints > 0 pooled).
+
+    The data table is written from the count matrix a batch of samples at a time rather than copied out
+    of the long cohort frame. When plot_jobs is a list the boxplot is queued on it for render_boxplots
+    instead of drawn here. With parquet=True the data and stats tables also get a typed Parquet copy.
+    '''
+    times = matrix.samples['time_from_treatment_start']
+    if timepoint is None:
+        #Exclude samples taken at time 0 (see the time 0 analysis that shows no significant differences in initial populations between responders and nonresponders)
+        subset = matrix.take(times.to_numpy() > 0)
+        drop = ['time_from_treatment_start']
+        data_path, stats_path, plot_path = "Outputs/cell_pops_miraclib.csv", "Outputs/population_stats.csv", "Outputs/stats_boxplot.png"
+        heading = "T-Test Results:"
+        title = 'Comparison of Relative Frequencies of Immune Cell Populations in Miraclib Responders vs. Non-Responders'
+    else:
+        subset = matrix.take(times.to_numpy() == timepoint)
+        drop = []
+        data_path, stats_path, plot_path = f"Outputs/cp_time{timepoint}.csv", f"Outputs/stats_time{timepoint}.csv", f"Outputs/stats_boxplot_time{timepoint}.png"
+        heading = f"T-Test Results when Time from Treatment = {timepoint}:"
+        title = f'Frequencies of Immune Cell Populations in Miraclib Responders vs. Non-Responders when Time From Treatment = {timepoint}'
+
+    frames = (frame.drop(columns=drop) for frame in subset.iter_long(max(chunk_rows // len(matrix.populations), 1)))
+    with instrumentation.span("write data", path=data_path) as span:
+        span['rows'] = write_frames(frames, data_path, parquet)
+
+    stratum = 'pooled' if timepoint is None else str(timepoint)
+    stats_df = stats[stats['stratum'] == stratum].drop(columns='stratum').reset_index(drop=True)
+    print(heading)
+    print(stats_df)
+    print()
+    if timepoint in blurbs:
+        print(blurbs[timepoint])
+        print()
+
+    write_table(stats_df, stats_path, parquet)
+    if plot_jobs is None:
+        with instrumentation.span("boxplot", path=plot_path):
+            boxplot(subset.to_long().drop(columns=drop), stats_df, title, plot_path)
+    else:
+        plot_jobs.append((data_path, stats_path, title, plot_path))
+    return stats_df
+
+
+def iter_strata(cohort):
+    '''Yield (stratum, population, response, percentages) for every group of the cohort.
+
+    The strata are 'pooled' (all timepoints > 0) followed by each timepoint, as strings.
+    '''
+    pooled = cohort[cohort['time_from_treatment_start'] > 0]
+    for stratum, data in [('pooled', pooled)] + [(str(t), d) for t, d in cohort.groupby('time_from_treatment_start')]:
+        for (pop, response), values in data.groupby(['population', 'response'], observed=True)['percentage']:
+            yield stratum, pop, response, values
+
+
+def boxplot_summaries(cohort):
+    '''Quartiles, whiskers, outliers and n of every (stratum, population, response) box, for drawing boxplots without the raw rows.
+
+    Uses matplotlib's own boxplot statistics (1.5 x IQR whiskers), so the dashboard's boxes match the
+    seaborn ones drawn here. Returns (summary frame, outliers frame with one row per outlier).
+    '''
+    summary, outliers = [], []
+    for stratum, pop, response, values in iter_strata(cohort):
+        box = cbook.boxplot_stats(values.to_numpy())[0]
+        key = {'stratum': stratum, 'population': pop, 'response': response}
+        summary.append({**key, 'n': len(values), 'whisker_low': box['whislo'], 'q1': box['q1'], 'median': box['med'], 'q3': box['q3'], 'whisker_high': box['whishi']})
+        outliers.extend({**key, 'percentage': value} for value in box['fliers'])
+    return pd.DataFrame(summary), pd.DataFrame(outliers, columns=['stratum', 'population', 'response', 'percentage'])
+
+
+def longitudinal_stats(matrix, baseline=0):
+    '''Change from baseline of every subject's relative frequencies, and paired tests of it by response.
+
+    The cohort becomes one subjects x timepoints x populations array, so every subject's follow-up minus
+    baseline is a single array subtraction; subjects missing either sample are NaN and drop out of the
+    tests. Returns (per-subject changes in long format, test results per timepoint and population), or
+    None when the cohort has no sample at the baseline timepoint.
+    '''
+    subjects, timepoints, values, observed = matrix.trajectories()
+    if baseline not in timepoints:
+        print(f"No samples at time {baseline} from treatment start, skipping the change from baseline tests")
+        print()
+        return None
+    responses = matrix.samples.drop_duplicates('subject_id').set_index('subject_id')['response'].reindex(subjects).to_numpy()
+    base = int(np.flatnonzero(timepoints == baseline)[0])
+    follow_up = [i for i in range(len(timepoints)) if i != base]
+
+    #subjects x follow-up timepoints x populations
+    changes = values[:, follow_up] - values[:, [base]]
+    tests = change_tests(changes, responses == 'yes')
+
+    #Long formats, keeping only the cells where both samples exist
+    populations = matrix.populations
+    s, t, p = np.nonzero(~np.isnan(changes))
+    trajectories = pd.DataFrame({
+        'subject_id': subjects[s],
+        'response': responses[s],
+        'time_from_treatment_start': timepoints[follow_up][t],
+        'population': pd.Categorical(populations[p], categories=populations),
+        'baseline_percentage': values[s, base, p],
+        'percentage': values[s, np.asarray(follow_up)[t], p],
+        'change': changes[s, t, p],
+    })
+
+    t, p = np.indices(changes.shape[1:]).reshape(2, -1)
+    stats = pd.DataFrame({
+        'time_from_treatment_start': timepoints[follow_up][t],
+        'population': populations[p],
+        'n_responders': tests['n_a'][t, p],
+        'n_non_responders': tests['n_b'][t, p],
+        'responder_mean_change': tests['mean_change_a'][t, p],
+        'non_responder_mean_change': tests['mean_change_b'][t, p],
+        'responder_paired_p_value': tests['paired_p_a'][t, p],
+        'non_responder_paired_p_value': tests['paired_p_b'][t, p],
+        't_statistic': tests['t_statistic'][t, p],
+        'p_value': tests['p_value'][t, p],
+    })
+    print(f"Subjects with a baseline sample: {int(observed[:, base].sum())} of {len(subjects)}; missing follow-ups are masked out")
+    print()
+    return trajectories, stats
+
+
+def resampling_stats(cohort, stats, n_permutations, n_bootstrap, seed, workers):
+    '''Add permutation p-values and bootstrap CIs of the mean difference to the Welch t-test results.'''
+    #Responder/non-responder percentages for every (stratum, population), pooled stratum included
+    groups = {}
+    for stratum, pop, response, values in iter_strata(cohort):
+        groups.setdefault((stratum, pop), {})[response] = values.to_numpy()
+    groups = {key: (g['yes'], g['no']) for key, g in groups.items() if 'yes' in g and 'no' in g}
+
+    results, rate = resampling_tests(groups, n_permutations, n_bootstrap, seed, workers)
+    print(f"Permutation tests: {len(groups)} comparisons x {n_permutations:,} permutations, {rate:,.0f} permutations/sec")
+    print()
+
+    results[['stratum', 'population']] = pd.DataFrame(results.pop('key').tolist(), index=results.index)
+    return stats.merge(results[['stratum', 'population', 'perm_p_value', 'ci_low', 'ci_high']], on=['stratum', 'population'], how='left')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare immune cell population frequencies between responders and non-responders.")
+    parser.add_argument("--permutations", type=int, default=0, help="also run permutation tests with this many label shuffles per comparison")
+    parser.add_argument("--bootstrap", type=int, default=10000, help="bootstrap resamples for the confidence intervals (with --permutations)")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the permutation and bootstrap RNG")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes for the permutation tests and headless plots (default: all cores)")
+    parser.add_argument("--headless", action="store_true", help="batch mode: render the boxplots in parallel without displaying them, skipping unchanged ones")
+    parser.add_argument("--parquet", action="store_true", help="also write typed Parquet copies of the output tables (needs pyarrow)")
+    args = parser.parse_args()
+    if args.parquet and pyarrow is None:
+        parser.error("--parquet needs pyarrow installed")
+    instrumentation.start("stat_analysis")
+    plot_jobs = None
+    if args.headless:
+        plt.switch_backend('Agg')
+        plot_jobs = []
+
+    #Get cell population relative frequency data for melanoma patients receiving miraclib, every timepoint at once
+    matrix = load_cohort_matrix()
+    cohort = matrix.to_long()
+    with instrumentation.span("t-tests", rows=len(cohort)) as span:
+        stats = stratum_stats(cohort)
+        span['tests'] = len(stats)
+
+    '''Compare Population Relative Frequencies in Immune Responses from Responders and Non-responders'''
+    analyze(matrix, stats, plot_jobs=plot_jobs, parquet=args.parquet)
+
+    '''Compare Population Relative Frequencies at Each Time Point from Treatment Start'''
+    #New timepoints (day 21, day 28...) are picked up from the data without another query
+    timepoints = [int(t) for t in sorted(cohort['time_from_treatment_start'].unique())]
+    for timepoint in timepoints:
+        analyze(matrix, stats, timepoint, plot_jobs, args.parquet)
+
+    if plot_jobs:
+        with instrumentation.span("render boxplots", plots=len(plot_jobs)):
+            render_boxplots(plot_jobs, args.workers)
+
+    #Compact box statistics so the dashboard can draw its boxplots without the raw rows
+    with instrumentation.span("boxplot summaries"):
+        summary, outliers = boxplot_summaries(cohort)
+    write_table(summary, "Outputs/boxplot_summary.csv", args.parquet)
+    write_table(outliers, "Outputs/boxplot_outliers.csv", args.parquet)
+
+    '''Change from Baseline in Each Subject: Paired Tests by Response'''
+    with instrumentation.span("longitudinal tests", samples=len(matrix.samples)):
+        longitudinal = longitudinal_stats(matrix)
+    if longitudinal is not None:
+        trajectories, change_stats = longitudinal
+        write_table(trajectories, "Outputs/trajectory_changes.csv", args.parquet)
+        for timepoint, change_df in change_stats.groupby('time_from_treatment_start'):
+            change_df = change_df.drop(columns='time_from_treatment_start').reset_index(drop=True)
+            print(f"Change from Baseline when Time from Treatment = {timepoint} (paired within each group, Welch's t-test between responders and non-responders):")
+            print(change_df.to_string(index=False))
+            print()
+            write_table(change_df, f"Outputs/stats_change_time{timepoint}.csv", args.parquet)
+
+    '''Permutation Tests and Bootstrap Confidence Intervals (t-tests assume roughly normal percentages)'''
+    if args.permutations > 0:
+        with instrumentation.span("resampling tests", permutations=args.permutations, bootstrap=args.bootstrap):
+            resampled = resampling_stats(cohort, stats, args.permutations, args.bootstrap, args.seed, args.workers)
+        for timepoint in [None] + timepoints:
+            stratum = 'pooled' if timepoint is None else str(timepoint)
+            path = "Outputs/population_stats_permutation.csv" if timepoint is None else f"Outputs/stats_time{timepoint}_permutation.csv"
+            resampled_df = resampled[resampled['stratum'] == stratum].drop(columns='stratum')
+            print(f"Permutation Test Results ({'timepoints > 0' if timepoint is None else f'Time from Treatment = {timepoint}'}):")
+            print(resampled_df.to_string(index=False))
+            print()
+            write_table(resampled_df, path, args.parquet)
+
+
+if __name__ == "__main__":
+    main()
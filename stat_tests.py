@@ -0,0 +1,182 @@
+'''Vectorized statistics shared by the analysis scripts'''
+
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.stats import t as t_dist
+
+
+def group_moments(data, by, value='percentage'):
+    '''Count, mean and sample variance of value for every group in by, in one groupby pass.'''
+    return data.groupby(by, observed=True)[value].agg(n='count', mean='mean', var='var').reset_index()
+
+
+def pool_moments(moments, by):
+    '''Combine the moments of all groups sharing the by keys into one set of moments per key.
+
+    Uses the parallel variance formula, so pooling timepoints never has to revisit the raw rows.
+    '''
+    m = moments.assign(total=moments['mean'] * moments['n'], m2=moments['var'].fillna(0) * (moments['n'] - 1))
+    pooled = m.groupby(by, observed=True).agg(n=('n', 'sum'), total=('total', 'sum'), m2=('m2', 'sum'))
+    pooled['mean'] = pooled['total'] / pooled['n']
+
+    #Spread of the group means around the pooled mean
+    m = m.join(pooled['mean'].rename('pooled_mean'), on=by)
+    pooled['m2'] += (m['n'] * (m['mean'] - m['pooled_mean']) ** 2).groupby([m[col] for col in by], observed=True).sum()
+
+    pooled['var'] = pooled['m2'] / (pooled['n'] - 1)
+    pooled.loc[pooled['n'] < 2, 'var'] = np.nan
+    return pooled[['n', 'mean', 'var']].reset_index()
+
+
+def cube_moments(cube, by, group='response'):
+    '''Count, mean and sample variance of the percentages per by + [group], from rows of the stats_cube table.
+
+    The cube holds n, sum and sum of squares per cell, so any slice of it (filter the rows first) pools by
+    plain addition over the dimensions left out of by, without reading a single raw row.
+    '''
+    sums = cube.groupby(by + [group], observed=True)[['n', 'sum_percentage', 'sumsq_percentage']].sum().reset_index()
+    n = sums['n']
+    mean = sums['sum_percentage'] / n
+    var = (sums['sumsq_percentage'] - sums['sum_percentage'] * mean) / (n - 1)
+    #Rounding can leave a constant group very slightly negative
+    var = var.clip(lower=0).where(n > 1)
+    return sums[by + [group]].assign(n=n, mean=mean, var=var)
+
+
+def welch_ttest(mean1, var1, n1, mean2, var2, n2):
+    '''Welch's t-test on arrays of group moments, returning arrays of (t statistic, two-sided p-value).'''
+    se1 = np.asarray(var1, dtype=float) / n1
+    se2 = np.asarray(var2, dtype=float) / n2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_stat = (np.asarray(mean1, dtype=float) - mean2) / np.sqrt(se1 + se2)
+        df = (se1 + se2) ** 2 / (se1 ** 2 / (np.asarray(n1) - 1) + se2 ** 2 / (np.asarray(n2) - 1))
+    p_value = 2 * t_dist.sf(np.abs(t_stat), df)
+    return t_stat, p_value
+
+
+def nan_moments(values, axis=0):
+    '''Count, mean and sample variance along axis, ignoring NaNs (missing observations).'''
+    n = np.sum(~np.isnan(values), axis=axis)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.nansum(values, axis=axis) / n
+        var = np.nansum((values - np.expand_dims(mean, axis)) ** 2, axis=axis) / (n - 1)
+    var = np.where(n > 1, var, np.nan)
+    return n, mean, var
+
+
+def one_sample_ttest(mean, var, n):
+    '''t-test of mean == 0 on arrays of moments (a paired t-test when the values are within-subject differences).'''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_stat = np.asarray(mean, dtype=float) / np.sqrt(np.asarray(var, dtype=float) / n)
+        p_value = 2 * t_dist.sf(np.abs(t_stat), np.asarray(n) - 1)
+    return t_stat, p_value
+
+
+def change_tests(changes, in_group):
+    '''Paired and between-group tests of per-subject changes, for every trailing cell of changes at once.
+
+    changes has subjects on axis 0 (NaN where a subject is missing either timepoint) and in_group marks
+    the subjects of the first group (e.g. responders). Each group's changes are tested against 0 (paired
+    t-test of follow-up vs. baseline) and the two groups' changes against each other (Welch's t-test).
+    Returns a dict of arrays shaped like changes[0].
+    '''
+    in_group = np.asarray(in_group, dtype=bool)
+    n_a, mean_a, var_a = nan_moments(changes[in_group])
+    n_b, mean_b, var_b = nan_moments(changes[~in_group])
+    paired_t_a, paired_p_a = one_sample_ttest(mean_a, var_a, n_a)
+    paired_t_b, paired_p_b = one_sample_ttest(mean_b, var_b, n_b)
+    t_stat, p_value = welch_ttest(mean_a, var_a, n_a, mean_b, var_b, n_b)
+    return {
+        'n_a': n_a, 'mean_change_a': mean_a, 'paired_t_a': paired_t_a, 'paired_p_a': paired_p_a,
+        'n_b': n_b, 'mean_change_b': mean_b, 'paired_t_b': paired_t_b, 'paired_p_b': paired_p_b,
+        't_statistic': t_stat, 'p_value': p_value,
+    }
+
+
+def welch_ttests(moments, by, group='response', a='yes', b='no'):
+    '''Welch's t-test of group a vs. group b for every key in by, evaluated in one vectorized call.
+
+    moments is a frame from group_moments/pool_moments with by + [group] as keys. Keys where either
+    group has no values are dropped, as the per-population loop used to skip them.
+    '''
+    wide = moments.set_index(by + [group])[['n', 'mean', 'var']].unstack(group)
+    if a not in wide['n'] or b not in wide['n']:
+        return pd.DataFrame(columns=by + ['responder_mean', 'non_responder_mean', 't_statistic', 'p_value'])
+    wide = wide[(wide['n'][a] > 0) & (wide['n'][b] > 0)]
+
+    t_stat, p_value = welch_ttest(wide['mean'][a], wide['var'][a], wide['n'][a],
+                                  wide['mean'][b], wide['var'][b], wide['n'][b])
+    stats = pd.DataFrame({
+        'responder_mean': wide['mean'][a].to_numpy(),
+        'non_responder_mean': wide['mean'][b].to_numpy(),
+        't_statistic': t_stat,
+        'p_value': p_value,
+    }, index=wide.index)
+    return stats.reset_index()
+
+
+def _resample(task):
+    '''Permutation p-value and bootstrap CI of the mean difference for one (responder, non-responder) pair.'''
+    key, yes, no, n_permutations, n_bootstrap, seed, memory_budget, confidence = task
+    #Separate streams for the shuffles and each group's draws, so the results don't depend on the batch sizes
+    perm_rng, yes_rng, no_rng = [np.random.default_rng(child) for child in seed.spawn(3)]
+    values = np.concatenate([yes, no])
+    n_yes, total = len(yes), values.sum()
+    observed = yes.mean() - no.mean()
+
+    #Shuffle the response labels a batch of permutations at a time: each row of the float label matrix is
+    #one permutation, so the responder sums of a whole batch are a single matrix-vector product
+    labels = np.zeros(len(values))
+    labels[:n_yes] = 1
+    batch_size = max(1, memory_budget // (labels.itemsize * len(values)))
+    extreme = 0
+    for start in range(0, n_permutations, batch_size):
+        size = min(batch_size, n_permutations - start)
+        yes_sums = perm_rng.permuted(np.broadcast_to(labels, (size, len(values))), axis=1) @ values
+        diffs = yes_sums / n_yes - (total - yes_sums) / (len(values) - n_yes)
+        extreme += np.count_nonzero(np.abs(diffs) >= abs(observed) - 1e-12)
+    perm_p = (extreme + 1) / (n_permutations + 1)
+
+    #Percentile bootstrap, resampling responders and non-responders separately; a batch holds an int64
+    #index matrix and the float values it gathers for the larger group
+    batch_size = max(1, memory_budget // (16 * max(len(yes), len(no))))
+    boot = []
+    for start in range(0, n_bootstrap, batch_size):
+        size = min(batch_size, n_bootstrap - start)
+        yes_means = yes[yes_rng.integers(0, len(yes), (size, len(yes)))].mean(axis=1)
+        no_means = no[no_rng.integers(0, len(no), (size, len(no)))].mean(axis=1)
+        boot.append(yes_means - no_means)
+    alpha = (1 - confidence) / 2
+    ci_low, ci_high = np.quantile(np.concatenate(boot), [alpha, 1 - alpha]) if boot else (np.nan, np.nan)
+
+    return key, observed, perm_p, ci_low, ci_high
+
+
+def resampling_tests(groups, n_permutations=10000, n_bootstrap=10000, seed=0, workers=None, memory_budget=4 * 2**20, confidence=0.95):
+    '''Permutation tests and bootstrap confidence intervals for many responder vs. non-responder comparisons.
+
+    groups maps a key (e.g. (stratum, population)) to a (responder values, non-responder values) pair.
+    Each comparison gets its own child of SeedSequence(seed), so results are reproducible regardless of
+    how the work is spread over the process pool. Resampling is batched so that each worker's batch
+    matrices stay within memory_budget bytes, however many samples a comparison has. Returns (results
+    frame, permutations per second).
+    '''
+    keys = list(groups)
+    seeds = np.random.SeedSequence(seed).spawn(len(keys))
+    tasks = [(key, np.asarray(groups[key][0], dtype=float), np.asarray(groups[key][1], dtype=float),
+              n_permutations, n_bootstrap, child, memory_budget, confidence) for key, child in zip(keys, seeds)]
+
+    start = time.perf_counter()
+    if workers == 1 or len(tasks) <= 1:
+        results = [_resample(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_resample, tasks))
+    elapsed = time.perf_counter() - start
+
+    frame = pd.DataFrame(results, columns=['key', 'mean_difference', 'perm_p_value', 'ci_low', 'ci_high'])
+    rate = len(tasks) * n_permutations / elapsed if elapsed > 0 else float('inf')
+    return frame, rate
@@ -1,62 +1,87 @@
 '''Part 4: Data Subset Analysis'''
 
+import argparse
+
 import pandas as pd
-import sqlite3
-
-con = sqlite3.connect("Outputs/loblawbio.db")
-
-#Identify all melanoma PBMC samples at baseline (time_from_treatment_start is 0) from patients who have been treated with miraclib.
-mel_PBMC_samples_t0 = pd.read_sql_query("""
-    SELECT sa.sample_id
-    FROM subjects su
-    JOIN samples sa ON su.subject_id = sa.subject_id
-    WHERE su.condition = 'melanoma' AND su.treatment = 'miraclib' AND sa.sample_type = 'PBMC' AND sa.time_from_treatment_start = 0;
-    """, con)
-
-print(mel_PBMC_samples_t0)
-print()
-mel_PBMC_samples_t0.to_csv("Outputs/mel_PBMC_samples_t0.csv", index=False)
-
-#1. How many samples from each project:
-project_sample_nums = pd.read_sql_query("""
-    SELECT sa.project, COUNT(sa.sample_id) AS sample_count
-    FROM subjects su
-    JOIN samples sa ON su.subject_id = sa.subject_id
-    WHERE su.condition = 'melanoma' AND su.treatment = 'miraclib' AND sa.sample_type = 'PBMC' AND sa.time_from_treatment_start = 0
-    GROUP BY sa.project;
-    """, con)
-
-print("Sample counts for each project:")
-print(project_sample_nums)
-print()
-project_sample_nums.to_csv("Outputs/project_sample_nums.csv", index=False)
-
-#2. How many subjects were responders/non-responders:
-response_subject_nums = pd.read_sql_query("""
-    SELECT su.response, COUNT(DISTINCT su.subject_id) AS subject_count
-    FROM subjects su
-    JOIN samples sa ON su.subject_id = sa.subject_id
-    WHERE su.condition = 'melanoma' AND su.treatment = 'miraclib' AND sa.sample_type = 'PBMC' AND sa.time_from_treatment_start = 0
-    GROUP BY su.response;
-    """, con)
-
-print("Subject counts for each response:")
-print(response_subject_nums)
-print()
-response_subject_nums.to_csv("Outputs/response_subject_nums.csv", index=False)
-
-#3. How many subjects were males/females:
-sex_subject_nums = pd.read_sql_query("""
-    SELECT su.sex, COUNT(su.subject_id) AS subject_count
-    FROM subjects su
-    JOIN samples sa ON su.subject_id = sa.subject_id
-    WHERE su.condition = 'melanoma' AND su.treatment = 'miraclib' AND sa.sample_type = 'PBMC' AND sa.time_from_treatment_start = 0
-    GROUP BY su.sex;
-    """, con)
-
-print("Subject counts for M/F:")
-print(sex_subject_nums)
-print()
-sex_subject_nums.to_csv("Outputs/sex_subject_nums.csv", index=False)
-
-con.close()
\ No newline at end of file
+
+import instrumentation
+import queries
+from exports import pyarrow, write_table
+
+database = "Outputs/loblawbio.db"
+
+#Breakdowns that can be requested with --by: dimension -> (what is counted, printed heading)
+dimensions = {
+    'project': ('samples', "Sample counts for each project:"),
+    'response': ('subjects', "Subject counts for each response:"),
+    'sex': ('subjects', "Subject counts for M/F:"),
+    'age_band': ('subjects', "Subject counts for each age band:"),
+}
+
+#Width in years of the age bands
+age_band_width = 10
+
+
+def load_subset(db_path=database, condition='melanoma', treatment='miraclib', sample_type='PBMC', timepoint=0):
+    '''Materialize the filtered cohort once; every breakdown is computed from this frame.'''
+    con = instrumentation.connect(db_path)
+    try:
+        with instrumentation.span("query subset") as span:
+            subset = pd.read_sql_query(queries.subset, con, params=(condition, treatment, sample_type, timepoint))
+            span['rows'] = len(subset)
+    finally:
+        con.close()
+    low = subset['age'] // age_band_width * age_band_width
+    subset['age_band'] = low.astype('Int64').astype(str) + "-" + (low + age_band_width - 1).astype('Int64').astype(str)
+    return subset
+
+
+def breakdown(subset, dimension):
+    '''Count samples or distinct subjects in the subset for each value of dimension.'''
+    unit, _ = dimensions[dimension]
+    column = 'sample_id' if unit == 'samples' else 'subject_id'
+    counts = subset.groupby(dimension, dropna=False)[column].nunique()
+    return counts.rename(f"{unit[:-1]}_count").reset_index()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Break down a cohort of samples by project, response, sex or age band.")
+    parser.add_argument("--condition", default="melanoma")
+    parser.add_argument("--treatment", default="miraclib")
+    parser.add_argument("--sample-type", default="PBMC")
+    parser.add_argument("--timepoint", type=int, default=0, help="time_from_treatment_start of the samples")
+    parser.add_argument("--by", nargs="+", choices=list(dimensions), default=['project', 'response', 'sex'], help="breakdowns to compute")
+    parser.add_argument("--parquet", action="store_true", help="also write typed Parquet copies of the output tables (needs pyarrow)")
+    args = parser.parse_args()
+    if args.parquet and pyarrow is None:
+        parser.error("--parquet needs pyarrow installed")
+    instrumentation.start("subset_analysis")
+
+    #Identify all melanoma PBMC samples at baseline (time_from_treatment_start is 0) from patients who have been treated with miraclib.
+    subset = load_subset(database, args.condition, args.treatment, args.sample_type, args.timepoint)
+
+    #The default cohort keeps its original file names, any other cohort gets its own prefix
+    if (args.condition, args.treatment, args.sample_type, args.timepoint) == ('melanoma', 'miraclib', 'PBMC', 0):
+        prefix, samples_file = "", "mel_PBMC_samples_t0.csv"
+    else:
+        prefix = f"{args.condition}_{args.treatment}_{args.sample_type}_t{args.timepoint}_"
+        samples_file = prefix + "samples.csv"
+
+    samples = subset[['sample_id']]
+    print(samples)
+    print()
+    write_table(samples, f"Outputs/{samples_file}", args.parquet)
+
+    #1. How many samples from each project, 2. how many subjects were responders/non-responders, 3. how many subjects were males/females (...)
+    for dimension in args.by:
+        unit, heading = dimensions[dimension]
+        with instrumentation.span(f"breakdown {dimension}", rows=len(subset)):
+            counts = breakdown(subset, dimension)
+        print(heading)
+        print(counts)
+        print()
+        write_table(counts, f"Outputs/{prefix}{dimension}_{unit[:-1]}_nums.csv", args.parquet)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,37 @@
 '''Part 2: Initial Analysis - Data Overview'''
 
-import pandas as pd
-import sqlite3
+import argparse
+
+import instrumentation
+import queries
+from exports import chunk_rows, export_query, pyarrow
+
+#Output file for each --compress choice
+outputs = {
+    None: "Outputs/relative_frequencies.csv",
+    'gzip': "Outputs/relative_frequencies.csv.gz",
+    'bz2': "Outputs/relative_frequencies.csv.bz2",
+    'xz': "Outputs/relative_frequencies.csv.xz",
+}
+
+parser = argparse.ArgumentParser(description="Summarize the relative frequency of every cell population in every sample.")
+parser.add_argument("--parquet", action="store_true", help="also write a typed Parquet copy of the table (needs pyarrow)")
+parser.add_argument("--compress", choices=[name for name in outputs if name], help="write a compressed CSV instead of a plain one")
+parser.add_argument("--chunk-rows", type=int, default=chunk_rows, help="rows fetched from the database and written per batch")
+args = parser.parse_args()
+if args.parquet and pyarrow is None:
+    parser.error("--parquet needs pyarrow installed")
+instrumentation.start("summary")
 
 #Connect to the SQLite database
-con = sqlite3.connect("Outputs/loblawbio.db")
-
-#Run SQL query
-relative_frequencies = pd.read_sql_query("""
-    SELECT cc.sample_id, totals.total_count, cc.population, cc.count, CAST(100.0 * cc.count AS FLOAT) / totals.total_count AS percentage
-    FROM cell_counts cc
-    JOIN (
-        SELECT sample_id, SUM(count) AS total_count
-        FROM cell_counts
-        GROUP BY sample_id
-    ) AS totals ON cc.sample_id = totals.sample_id;
-    """, con)
-
-print(relative_frequencies)
-relative_frequencies.to_csv("Outputs/relative_frequencies.csv", index=False)
-
-con.close()
\ No newline at end of file
+con = instrumentation.connect("Outputs/loblawbio.db")
+
+#Stream the relative frequencies from the cursor to the file a batch at a time, so memory stays flat however many samples there are
+path = outputs[args.compress]
+with instrumentation.span("export relative_frequencies", path=path) as span:
+    cur = con.execute(queries.relative_frequencies)
+    span['rows'] = export_query(cur, path, args.parquet, args.chunk_rows)
+
+print(f"Wrote the relative frequencies of {span['rows']:,} sample populations to {path}")
+
+con.close()